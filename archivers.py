@@ -0,0 +1,174 @@
+"""
+Archive format backends for the File Compressor Bot.
+Every format implements Archiver.create(), so single files and merges go through
+the same code whatever the output format is.
+"""
+
+import asyncio
+import os
+import re
+import shutil
+import tempfile
+
+import policy
+
+PERCENT = re.compile(rb'(\d{1,3})%')
+
+
+class ArchiverError(Exception):
+    """Raised when an archive could not be created"""
+
+
+class Archiver:
+    """Base class for archive formats"""
+
+    extension = None
+    label = None
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def available(self):
+        return True
+
+    async def create(self, user_id, output_path, entries, profile=policy.DEFAULT_PROFILE, progress=None):
+        """Write (path, arcname) entries to output_path.
+
+        progress(done_bytes) is called as input bytes get compressed.
+        """
+        raise NotImplementedError
+
+
+class ZipArchiver(Archiver):
+    extension = 'zip'
+    label = "ZIP"
+
+    async def create(self, user_id, output_path, entries, profile=policy.DEFAULT_PROFILE, progress=None):
+        # One file per job so progress keeps updating and other users get a turn in between
+        done = 0
+        for i, (path, arcname) in enumerate(entries):
+            await self.engine.zip(user_id, output_path, [(path, arcname)], 'w' if i == 0 else 'a', profile)
+            done += os.path.getsize(path)
+            if progress:
+                progress(done)
+        return output_path
+
+    async def create_bytes(self, user_id, entries, profile=policy.DEFAULT_PROFILE, progress=None):
+        """Build the archive in the worker and return its bytes instead of writing a file"""
+        entries = list(entries)
+        data = await self.engine.zip_bytes(user_id, entries, profile)
+        if progress:
+            progress(sum(os.path.getsize(path) for path, _ in entries))
+        return data
+
+
+class TarGzArchiver(Archiver):
+    extension = 'tar.gz'
+    label = "TAR.GZ"
+
+    async def create(self, user_id, output_path, entries, profile=policy.DEFAULT_PROFILE, progress=None):
+        entries = list(entries)
+        # tar.gz is one deflate stream, so go with the level that suits most of its bytes
+        level = policy.deflate_level_for(entries, profile)
+        await self.engine.compress_parallel(user_id, entries, output_path, 'tar.gz', level)
+        if progress:
+            progress(sum(os.path.getsize(path) for path, _ in entries))
+        return output_path
+
+
+class ExternalArchiver(Archiver):
+    """Runs a multi-threaded command line archiver and follows its percentage output"""
+
+    # profile -> compression level switch
+    LEVELS = {}
+
+    def __init__(self, engine, binary, threads):
+        super().__init__(engine)
+        self.binary = binary
+        self.threads = threads
+
+    def available(self):
+        return shutil.which(self.binary) is not None
+
+    def command(self, output_path, names, profile):
+        raise NotImplementedError
+
+    async def create(self, user_id, output_path, entries, profile=policy.DEFAULT_PROFILE, progress=None):
+        if not self.available():
+            raise ArchiverError(f"{self.binary} is not installed on the server")
+        entries = list(entries)
+        total = sum(os.path.getsize(path) for path, _ in entries)
+        output_path = os.path.abspath(output_path)
+
+        async with self.engine.slot(user_id):
+            # Give every input its archive name - hard links cost no extra disk space
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(output_path)) as stage:
+                names = []
+                for path, arcname in entries:
+                    name = os.path.basename(arcname) or "file"
+                    while name in names:
+                        name = f"_{name}"
+                    try:
+                        os.link(path, os.path.join(stage, name))
+                    except OSError:
+                        await asyncio.to_thread(shutil.copyfile, path, os.path.join(stage, name))
+                    names.append(name)
+
+                process = await asyncio.create_subprocess_exec(
+                    *self.command(output_path, names, profile),
+                    cwd=stage,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                errors = asyncio.ensure_future(process.stderr.read())
+                try:
+                    # Progress is drawn with \r and \b, so read raw chunks instead of lines
+                    while True:
+                        chunk = await process.stdout.read(512)
+                        if not chunk:
+                            break
+                        found = PERCENT.findall(chunk)
+                        if found and progress:
+                            progress(total * min(int(found[-1]), 100) // 100)
+                    code = await process.wait()
+                    stderr = (await errors).decode(errors='replace').strip()
+                except BaseException:
+                    # Cancelled or failed - don't leave the archiver running on a directory we delete
+                    errors.cancel()
+                    if process.returncode is None:
+                        process.kill()
+                    await process.wait()
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    raise
+
+        if code != 0:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise ArchiverError(f"{self.binary} failed ({code}): {stderr[-300:]}")
+        if progress:
+            progress(total)
+        return output_path
+
+
+class RarArchiver(ExternalArchiver):
+    extension = 'rar'
+    label = "RAR"
+    LEVELS = {'fast': '-m1', 'balanced': '-m3', 'max': '-m5'}
+
+    def command(self, output_path, names, profile):
+        level = self.LEVELS.get(profile, '-m3')
+        return [self.binary, 'a', '-y', '-idc', level, f'-mt{self.threads}', output_path, '--', *names]
+
+
+class SevenZipArchiver(ExternalArchiver):
+    extension = '7z'
+    label = "7Z"
+    LEVELS = {'fast': '-mx1', 'balanced': '-mx5', 'max': '-mx9'}
+
+    def command(self, output_path, names, profile):
+        level = self.LEVELS.get(profile, '-mx5')
+        return [
+            self.binary, 'a', '-t7z', '-y', level, f'-mmt{self.threads}', '-bsp1', '-bso0',
+            output_path, '--', *names
+        ]
@@ -0,0 +1,469 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmark for the File Compressor Bot.
+Runs the real Application against a local stand-in for the Telegram Bot API that serves
+synthetic documents and swallows uploads, replays concurrent users doing single-file and
+merge flows, and reports throughput, latency, event-loop lag and peak memory/disk use.
+
+    python benchmark.py --users 8 --rounds 3 --size-mb 4 --compressibility 0.5
+"""
+
+import argparse
+import asyncio
+import email.parser
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+TOKEN = "123456:benchmark"
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': "Compressor", 'username': "compressor_bot"}
+CHUNK_SIZE = 64 * 1024
+TEXT = b"The quick brown fox jumps over the lazy dog while the bot compresses everything. "
+FIRST_USER_ID = 10_000_001
+
+
+def synthetic_chunks(seed, size, compressibility):
+    """Deterministic document bytes; compressibility is the share of each chunk that is plain text"""
+    rng = random.Random(seed)
+    text_size = int(CHUNK_SIZE * compressibility)
+    text = (TEXT * (text_size // len(TEXT) + 1))[:text_size]
+    left = size
+    while left > 0:
+        chunk = text + rng.randbytes(CHUNK_SIZE - text_size)
+        yield chunk[:left]
+        left -= len(chunk)
+
+
+class FakeBotAPI:
+    """Just enough of the Bot API for the bot's flows, served from a background thread"""
+
+    def __init__(self, loop, compressibility=0.5, poll_timeout=1.0, local_dir=None):
+        self.loop = loop
+        self.compressibility = compressibility
+        self.local_dir = local_dir  # like telegram-bot-api --local: files are handed over as paths
+        self.poll_timeout = poll_timeout
+        self.documents = {}  # file_id -> size
+        self.uploaded_bytes = 0
+        self.calls = {}
+        self._updates = []
+        self._cond = threading.Condition()
+        self._ids = itertools.count(1)
+        self._inboxes = {}  # chat_id -> asyncio.Queue of bot messages
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # What users do
+
+    def document(self, size):
+        file_id = f"doc{next(self._ids)}"
+        self.documents[file_id] = size
+        return {
+            'file_id': file_id, 'file_unique_id': f"u{file_id}", 'file_name': f"{file_id}.dat",
+            'mime_type': "application/octet-stream", 'file_size': size,
+        }
+
+    def _user_message(self, user_id, **fields):
+        return {
+            'message_id': next(self._ids), 'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+            **fields,
+        }
+
+    def _push(self, update):
+        with self._cond:
+            update['update_id'] = next(self._ids)
+            self._updates.append(update)
+            self._cond.notify_all()
+
+    def send_document(self, user_id, size):
+        document = self.document(size)
+        self._push({'message': self._user_message(user_id, document=document)})
+        return document
+
+    def send_text(self, user_id, text):
+        entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else None
+        message = self._user_message(user_id, text=text)
+        if entities:
+            message['entities'] = entities
+        self._push({'message': message})
+
+    def press(self, user_id, data):
+        self._push({'callback_query': {
+            'id': str(next(self._ids)), 'chat_instance': str(user_id), 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+            'message': {**self._user_message(user_id, text="menu"), 'from': BOT_USER},
+        }})
+
+    async def expect(self, user_id, predicate, timeout=300.0):
+        """Wait for the bot to send or edit a message for user_id that matches predicate"""
+        inbox = self.inbox(user_id)
+        async with asyncio.timeout(timeout):
+            while True:
+                event = await inbox.get()
+                if predicate(event):
+                    return event
+                if event['text'].startswith(("❌", "⏳")):
+                    raise RuntimeError(f"user {user_id}: {event['text']}")
+
+    def inbox(self, chat_id):
+        return self._inboxes.setdefault(int(chat_id), asyncio.Queue())
+
+    # What the bot does
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), self.poll_timeout)
+        with self._cond:
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._cond.wait(deadline - time.monotonic())
+            return list(self._updates)
+
+    def _bot_message(self, method, params, upload_size=None):
+        chat_id = int(params.get('chat_id', 0))
+        message = {
+            'message_id': int(params.get('message_id') or next(self._ids)), 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER,
+        }
+        text = params.get('text') or params.get('caption') or ""
+        if method == 'sendDocument':
+            file_id = f"out{next(self._ids)}"
+            message['document'] = {'file_id': file_id, 'file_unique_id': f"u{file_id}", 'file_size': upload_size or 0}
+            if params.get('caption'):
+                message['caption'] = params['caption']
+        else:
+            message['text'] = text
+        event = {'method': method, 'text': text, 'size': upload_size}
+        self.loop.call_soon_threadsafe(self.inbox(chat_id).put_nowait, event)
+        return message
+
+    def _file_path(self, file_id):
+        if not self.local_dir:
+            return f"documents/{file_id}"
+        path = os.path.join(self.local_dir, file_id)
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                for chunk in synthetic_chunks(file_id, self.documents[file_id], self.compressibility):
+                    f.write(chunk)
+        return path
+
+    def call(self, method, params, upload_size=None):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        if method == 'getFile':
+            file_id = params['file_id']
+            return {
+                'file_id': file_id, 'file_unique_id': f"u{file_id}",
+                'file_size': self.documents[file_id], 'file_path': self._file_path(file_id),
+            }
+        if method == 'sendDocument' and str(params.get('document', '')).startswith("file://"):
+            upload_size = os.path.getsize(params['document'][len("file://"):])
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            if upload_size:
+                self.uploaded_bytes += upload_size
+            return self._bot_message(method, params, upload_size)
+        return True
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, payload):
+                body = json.dumps({'ok': True, 'result': payload}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                file_id = self.path.rsplit('/', 1)[-1]
+                size = api.documents.get(file_id)
+                if size is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.end_headers()
+                for chunk in synthetic_chunks(file_id, size, api.compressibility):
+                    self.wfile.write(chunk)
+
+            def do_POST(self):
+                method = self.path.rsplit('/', 1)[-1]
+                content_type = self.headers.get("Content-Type", "")
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = self._read_chunked()
+                else:
+                    body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                params, upload_size = {}, None
+                if content_type.startswith("application/json"):
+                    params = json.loads(body or b"{}")
+                elif content_type.startswith("multipart/form-data"):
+                    parsed = email.parser.BytesParser().parsebytes(
+                        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+                    )
+                    for part in parsed.get_payload():
+                        payload = part.get_payload(decode=True) or b""
+                        if part.get_filename():
+                            upload_size = len(payload)
+                        else:
+                            params[part.get_param('name', header='content-disposition')] = payload.decode()
+                else:
+                    params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+                self._reply(api.call(method, params, upload_size))
+
+            def _read_chunked(self):
+                body = b""
+                while True:
+                    size = int(self.rfile.readline().strip(), 16)
+                    if not size:
+                        self.rfile.readline()
+                        return body
+                    body += self.rfile.read(size)
+                    self.rfile.readline()
+
+        return Handler
+
+
+class Sampler:
+    """Measures event-loop lag and peak RSS (bot plus worker processes) and disk use"""
+
+    def __init__(self, directory, interval=0.05):
+        self.directory = directory
+        self.interval = interval
+        self.lags = []
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        ticks = 0
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(time.monotonic() - before - self.interval, 0.0))
+            ticks += 1
+            if ticks % 5 == 0:
+                self.peak_rss = max(self.peak_rss, rss())
+                self.peak_disk = max(self.peak_disk, disk_usage(self.directory))
+
+
+def rss():
+    """Resident memory of this process and its children in bytes (Linux /proc)"""
+    import multiprocessing
+    total = 0
+    for pid in [os.getpid()] + [p.pid for p in multiprocessing.active_children()]:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def disk_usage(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # removed while we were looking
+    return total
+
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+async def single_flow(api, user_id, size):
+    """Send one document, answer the caption prompt, wait for the archive"""
+    api.send_document(user_id, size)
+    await api.expect(user_id, lambda e: "Reply with caption" in e['text'])
+    api.send_text(user_id, "benchmark")
+    await api.expect(user_id, lambda e: e['method'] == 'sendDocument')
+    return 1, size
+
+
+async def merge_flow(api, user_id, size, files):
+    """Switch to merge mode, send several documents, /done, caption, wait for the archive"""
+    api.press(user_id, "mode_merge")
+    await api.expect(user_id, lambda e: "Merge Mode" in e['text'])
+    for _ in range(files):
+        api.send_document(user_id, size)
+    for _ in range(files):
+        await api.expect(user_id, lambda e: "File added" in e['text'])
+    api.send_text(user_id, "/done")
+    await api.expect(user_id, lambda e: "Enter caption" in e['text'])
+    api.send_text(user_id, "benchmark")
+    await api.expect(user_id, lambda e: e['method'] == 'sendDocument')
+    return files, size * files
+
+
+async def run_user(api, user_id, args, latencies, totals):
+    merge = args.flow == 'merge' or (args.flow == 'mixed' and user_id % 2 == 0)
+    for _ in range(args.rounds):
+        start = time.monotonic()
+        if merge:
+            files, size = await merge_flow(api, user_id, args.size, args.merge_files)
+        else:
+            files, size = await single_flow(api, user_id, args.size)
+        latencies.append(time.monotonic() - start)
+        totals[0] += files
+        totals[1] += size
+
+
+async def benchmark(args):
+    loop = asyncio.get_running_loop()
+    workdir = tempfile.mkdtemp(prefix="compressor_bench_")
+    local_dir = None
+    if args.local:
+        local_dir = os.path.join(workdir, "server")
+        os.makedirs(local_dir)
+    api = FakeBotAPI(loop, args.compressibility, local_dir=local_dir)
+    api.start()
+    os.environ.update({
+        'LOCAL_BOT_API': "1" if args.local else "0",
+        'BOT_TOKEN': TOKEN,
+        'BOT_API_URL': f"{api.url}/bot",
+        'BOT_FILE_URL': f"{api.url}/file/bot",
+        'DOWNLOAD_DIR': workdir,
+        'METRICS_PORT': '0',
+    })
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+
+    users = [FIRST_USER_ID + i for i in range(args.users)]
+    bot.ALLOWED_USERS.extend(users)
+    application = bot.build_application()
+    sampler = Sampler(workdir)
+    latencies, totals = [], [0, 0]
+    try:
+        async with application:
+            await application.post_init(application)
+            try:
+                await application.start()
+                await application.updater.start_polling(poll_interval=0.0, timeout=1, allowed_updates=bot.ALLOWED_UPDATES)
+                sampler.start()
+                started = time.monotonic()
+                await asyncio.gather(*[run_user(api, user_id, args, latencies, totals) for user_id in users])
+                elapsed = time.monotonic() - started
+            finally:
+                # A failed run must not leave the poller, pools or background tasks behind
+                await sampler.stop()
+                if application.updater.running:
+                    await application.updater.stop()
+                if application.running:
+                    await application.stop()
+                await application.post_shutdown(application)
+        queue = bot.jobs.stats()
+        stages = {
+            stage: {'count': h.count, 'mean': h.mean, 'mb_per_s': bot.metrics.stage_bytes[stage] / 1024 / 1024 / h.sum}
+            for stage, h in bot.metrics.stage_seconds.items() if h.sum
+        }
+    finally:
+        bot.engine.shutdown()
+        bot.jobs.close()
+        api.stop()
+
+    files, size = totals
+    return {
+        'local': args.local, 'users': args.users, 'rounds': args.rounds, 'flow': args.flow,
+        'size_mb': args.size / 1024 / 1024, 'compressibility': args.compressibility,
+        'files': files, 'seconds': elapsed,
+        'files_per_s': files / elapsed, 'mb_per_s': size / 1024 / 1024 / elapsed,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p95': percentile(latencies, 0.95),
+        'latency_p99': percentile(latencies, 0.99),
+        'loop_lag_p99': percentile(sampler.lags, 0.99),
+        'loop_lag_max': max(sampler.lags, default=0.0),
+        'peak_rss_mb': sampler.peak_rss / 1024 / 1024,
+        'peak_disk_mb': sampler.peak_disk / 1024 / 1024,
+        'uploaded_mb': api.uploaded_bytes / 1024 / 1024,
+        'queue_wait_avg': queue['avg_wait'],
+        'queue_wait_p95': queue['p95_wait'],
+        'stages': stages,
+        'api_calls': api.calls,
+    }
+
+
+def report(result):
+    print(f"📊 {result['files']} files from {result['users']} users ({result['flow']}) in {result['seconds']:.1f}s")
+    print(f"   Throughput: {result['files_per_s']:.2f} files/s · {result['mb_per_s']:.1f} MB/s")
+    print(f"   Latency:    p50 {result['latency_p50']:.2f}s · p95 {result['latency_p95']:.2f}s"
+          f" · p99 {result['latency_p99']:.2f}s")
+    print(f"   Loop lag:   p99 {result['loop_lag_p99'] * 1000:.1f}ms · max {result['loop_lag_max'] * 1000:.1f}ms")
+    print(f"   Peak RSS:   {result['peak_rss_mb']:.0f} MB · peak disk {result['peak_disk_mb']:.0f} MB")
+    print(f"   Queue wait: avg {result['queue_wait_avg']:.2f}s · p95 {result['queue_wait_p95']:.2f}s")
+    for stage, numbers in sorted(result['stages'].items()):
+        speed = f" · {numbers['mb_per_s']:.1f} MB/s" if numbers['mb_per_s'] else ""
+        print(f"   {stage + ':':<11} {numbers['count']}× · avg {numbers['mean']:.3f}s{speed}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=4, help="concurrent users")
+    parser.add_argument("--rounds", type=int, default=2, help="flows each user runs one after another")
+    parser.add_argument("--flow", choices=("single", "merge", "mixed"), default="mixed")
+    parser.add_argument("--merge-files", type=int, default=4, help="documents per merge")
+    parser.add_argument("--size-mb", type=float, default=2.0, help="size of every document")
+    parser.add_argument("--compressibility", type=float, default=0.5, help="0 = random bytes, 1 = plain text")
+    parser.add_argument("--local", action="store_true", help="act like a telegram-bot-api server in --local mode")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+    args.size = int(args.size_mb * 1024 * 1024)
+
+    result = asyncio.run(benchmark(args))
+    report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
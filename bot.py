@@ -1,29 +1,144 @@
 #!/usr/bin/env python3
 """
 File Compressor Bot for Telegram
-Compresses files to zip/rar and can merge multiple files into one archive.
+Compresses files to zip/rar/7z/tar.gz and can merge multiple files into one archive.
 Styled buttons with colors!
 """
 
 import os
-import zipfile
+import uuid
+import logging
+import shutil
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+import pathlib
+import tempfile
+import httpx
+from telegram import InputFile, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, ExtBot, MessageHandler, filters, ContextTypes, CallbackQueryHandler
+from telegram.request import HTTPXRequest
+
+import policy
+from archivers import ArchiverError, RarArchiver, SevenZipArchiver, TarGzArchiver, ZipArchiver
+from cache import InputCache, ResultCache
+from engine import CompressionEngine, EngineBusy
+from jobqueue import JobQueue
+from metrics import JobMetrics, registry as metrics
+from progress import ProgressReader, ProgressReporter, format_size
+from scheduler import DownloadScheduler
+from storage import Spool, Storage
+from streaming import download_to_path, stream_zip_upload
 
 # Configuration
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8761176747:AAHJUoC3FeCuj_v8v8qGg1MV-kE2V_cCst4")
-DOWNLOAD_DIR = "/tmp/compressor_bot/"
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB limit
+DOWNLOAD_DIR = os.environ.get("DOWNLOAD_DIR", "/tmp/compressor_bot/")
+LOCAL_BOT_API = os.environ.get("LOCAL_BOT_API", "0") == "1"  # Self-hosted telegram-bot-api running with --local
+MAX_FILE_SIZE = int(os.environ.get("MAX_FILE_MB", 2000 if LOCAL_BOT_API else 50)) * 1024 * 1024
 ALLOWED_USERS = [971043547]  # Only these user IDs can use the bot
+COMPRESS_WORKERS = int(os.environ.get("COMPRESS_WORKERS", os.cpu_count() or 2))  # Worker processes for compression
+COMPRESS_PER_USER = int(os.environ.get("COMPRESS_PER_USER", 1))  # Parallel compression jobs per user
+COMPRESS_MAX_WAITING = int(os.environ.get("COMPRESS_MAX_WAITING", 16))  # Queued jobs before we turn users away
+PARALLEL_BLOCK_SIZE = int(os.environ.get("PARALLEL_BLOCK_KB", 1024)) * 1024  # Block size for multi-core deflate
+PARALLEL_WORKERS = int(os.environ.get("PARALLEL_WORKERS", COMPRESS_WORKERS))  # Workers one big file may use
+PARALLEL_THRESHOLD = int(os.environ.get("PARALLEL_THRESHOLD_MB", 8)) * 1024 * 1024  # Files this big use all cores
+STREAMING = os.environ.get("STREAMING", "0") == "1" and not LOCAL_BOT_API  # Download -> ZIP -> upload without temp files
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 256 * 1024))
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", 8))  # Chunks buffered per direction
+DEFAULT_PROFILE = os.environ.get("COMPRESS_PROFILE", policy.DEFAULT_PROFILE)  # fast, balanced or max
+INPUT_CACHE_BYTES = int(os.environ.get("INPUT_CACHE_MB", 1024)) * 1024 * 1024  # Disk budget for cached downloads
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", 64))  # Updates handled at the same time
+MAX_DOWNLOADS = int(os.environ.get("MAX_DOWNLOADS", 8))  # Parallel downloads for the whole bot
+MAX_DOWNLOADS_PER_USER = int(os.environ.get("MAX_DOWNLOADS_PER_USER", 3))
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", 3.0))  # Min seconds between progress edits
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", os.path.join(DOWNLOAD_DIR, "results.json"))
+RAR_BINARY = os.environ.get("RAR_BINARY", "rar")
+SEVENZIP_BINARY = os.environ.get("SEVENZIP_BINARY", "7z")
+ARCHIVER_THREADS = int(os.environ.get("ARCHIVER_THREADS", COMPRESS_WORKERS))  # Threads for rar/7z
+STORAGE_QUOTA = int(os.environ.get("STORAGE_QUOTA_MB", 4096)) * 1024 * 1024  # Disk for archives being built
+SPOOL_MAX = int(os.environ.get("SPOOL_KB", 1024)) * 1024  # Finished archives this small stay in memory
+STORAGE_TTL = float(os.environ.get("STORAGE_TTL_MIN", 60)) * 60  # Idle sessions lose their files after this
+JOB_DB_PATH = os.environ.get("JOB_DB_PATH", os.path.join(DOWNLOAD_DIR, "jobs.db"))
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org/bot")  # Point at a local server for tests
+BOT_FILE_URL = os.environ.get("BOT_FILE_URL", "https://api.telegram.org/file/bot")
+JOB_SLOTS = int(os.environ.get("JOB_SLOTS", COMPRESS_WORKERS))  # Archives built at the same time
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")  # Public https URL; empty means long polling
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", 8443))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")  # Checked against X-Telegram-Bot-Api-Secret-Token
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 30))  # Seconds getUpdates is held open by Telegram
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 16))  # Connections for messages, edits and callbacks
+UPLOAD_POOL_SIZE = int(os.environ.get("UPLOAD_POOL_SIZE", 4))  # Connections for sending archives
+DOWNLOAD_POOL_SIZE = int(os.environ.get("DOWNLOAD_POOL_SIZE", MAX_DOWNLOADS))  # Connections for fetching files
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))  # Prometheus endpoint, 0 turns it off
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+engine = CompressionEngine(
+    COMPRESS_WORKERS, COMPRESS_PER_USER, COMPRESS_MAX_WAITING,
+    PARALLEL_BLOCK_SIZE, PARALLEL_WORKERS, PARALLEL_THRESHOLD
+)
+input_cache = InputCache(os.path.join(DOWNLOAD_DIR, "cache"), INPUT_CACHE_BYTES)
+result_cache = ResultCache(RESULT_CACHE_PATH)
+downloads = DownloadScheduler(MAX_DOWNLOADS, MAX_DOWNLOADS_PER_USER)
+storage = Storage(os.path.join(DOWNLOAD_DIR, "jobs"), STORAGE_QUOTA, SPOOL_MAX, STORAGE_TTL)
+jobs = JobQueue(JOB_DB_PATH, JOB_SLOTS)
+# The handlers only look at messages and button presses
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Small API calls, uploads and downloads each get their own pool, so a few big transfers
+# can't leave a progress edit waiting for a connection
+api_request = HTTPXRequest(
+    connection_pool_size=API_POOL_SIZE, connect_timeout=5.0, read_timeout=15.0, write_timeout=15.0, pool_timeout=10.0
+)
+updates_request = HTTPXRequest(
+    connection_pool_size=1, connect_timeout=5.0, read_timeout=POLL_TIMEOUT + 10.0, write_timeout=5.0, pool_timeout=5.0
+)
+uploader = ExtBot(
+    BOT_TOKEN, base_url=BOT_API_URL, base_file_url=BOT_FILE_URL, local_mode=LOCAL_BOT_API,
+    request=HTTPXRequest(
+        connection_pool_size=UPLOAD_POOL_SIZE, connect_timeout=5.0, read_timeout=120.0, write_timeout=None,
+        pool_timeout=None
+    )
+)
+file_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=DOWNLOAD_POOL_SIZE, max_keepalive_connections=DOWNLOAD_POOL_SIZE),
+    timeout=httpx.Timeout(60.0, connect=5.0, write=None, pool=None)
+)
+# Streamed uploads post straight to the Bot API, so they share the upload pool's size, not the download pool
+stream_upload_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=UPLOAD_POOL_SIZE, max_keepalive_connections=UPLOAD_POOL_SIZE),
+    timeout=httpx.Timeout(120.0, connect=5.0, write=None, pool=None)
+)
+
+archivers = {
+    'zip': ZipArchiver(engine),
+    'tar.gz': TarGzArchiver(engine),
+    'rar': RarArchiver(engine, RAR_BINARY, ARCHIVER_THREADS),
+    '7z': SevenZipArchiver(engine, SEVENZIP_BINARY, ARCHIVER_THREADS),
+}
+
+metrics.gauge("compressor_queue_depth", "Jobs waiting for a worker", lambda: jobs.depth)
+metrics.gauge("compressor_queue_running", "Jobs holding a worker", lambda: jobs.running)
+metrics.gauge("compressor_engine_waiting", "Compression calls waiting for the process pool", lambda: engine.waiting)
+metrics.gauge("compressor_storage_bytes", "Disk quota claimed by jobs", lambda: storage.used)
+metrics.gauge("compressor_storage_waiting", "Jobs waiting for disk quota", lambda: storage.waiting)
+metrics.gauge("compressor_storage_spaces", "Job directories alive", lambda: len(storage.spaces))
+metrics.gauge("compressor_input_cache_bytes", "Bytes in the input cache", lambda: input_cache.size)
+metrics.counter("compressor_input_cache_hits_total", "Input cache hits since start", lambda: input_cache.hits)
+metrics.counter("compressor_input_cache_misses_total", "Input cache misses since start", lambda: input_cache.misses)
+
 # Stylish menu keyboard with colors using bg_color and text_color
 def get_main_menu():
     keyboard = [
-        [InlineKeyboardButton("📇 Compress to ZIP", callback_data="mode_zip", bg_color=Update.BUTTON_COLOR_PRIMARY)],
+        [
+            InlineKeyboardButton("📇 Compress to ZIP", callback_data="mode_zip", bg_color=Update.BUTTON_COLOR_PRIMARY),
+            InlineKeyboardButton("⚙️ Speed/Ratio", callback_data="profile_menu", bg_color=Update.BUTTON_COLOR_SECONDARY),
+        ],
         [InlineKeyboardButton("📦 Compress to RAR", callback_data="mode_rar", bg_color=Update.BUTTON_COLOR_PRIMARY)],
+        [InlineKeyboardButton("🗜 Compress to 7Z", callback_data="mode_7z", bg_color=Update.BUTTON_COLOR_PRIMARY)],
+        [InlineKeyboardButton("🗜 Compress to TAR.GZ", callback_data="mode_targz", bg_color=Update.BUTTON_COLOR_PRIMARY)],
         [InlineKeyboardButton("🔀 Merge Files", callback_data="mode_merge", bg_color=Update.BUTTON_COLOR_PRIMARY)],
         [InlineKeyboardButton("❌ Cancel", callback_data="cancel", bg_color=Update.BUTTON_COLOR_DANGER)],
     ]
@@ -35,18 +150,208 @@ def get_zip_menu():
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
     ])
 
+def get_skip_single_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("⏭️ Skip", callback_data="skip_caption_single", bg_color=Update.BUTTON_COLOR_SECONDARY)]
+    ])
+
+def get_profile_menu(current):
+    buttons = [
+        InlineKeyboardButton(
+            f"{'✅ ' if name == current else ''}{label}",
+            callback_data=f"profile_{name}",
+            bg_color=Update.BUTTON_COLOR_SUCCESS if name == current else Update.BUTTON_COLOR_PRIMARY
+        )
+        for name, label in policy.PROFILE_LABELS.items()
+    ]
+    return InlineKeyboardMarkup([
+        buttons,
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
+    ])
+
 def get_rar_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("📦 Compress to RAR", callback_data="mode_rar", bg_color=Update.BUTTON_COLOR_PRIMARY)],
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
     ])
 
+def get_7z_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🗜 Compress to 7Z", callback_data="mode_7z", bg_color=Update.BUTTON_COLOR_PRIMARY)],
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
+    ])
+
+def get_targz_menu():
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🗜 Compress to TAR.GZ", callback_data="mode_targz", bg_color=Update.BUTTON_COLOR_PRIMARY)],
+        [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
+    ])
+
 def get_merge_menu():
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("✅ Done - Create Archive", callback_data="done_merge", bg_color=Update.BUTTON_COLOR_SUCCESS)],
         [InlineKeyboardButton("🔙 Back to Menu", callback_data="back_menu", bg_color=Update.BUTTON_COLOR_SECONDARY)],
     ])
 
+def get_profile(context):
+    return context.user_data.get('profile', DEFAULT_PROFILE)
+
+def get_archiver(context):
+    return archivers[context.user_data.get('compress_mode', 'zip')]
+
+def add_to_merge_archive(context, user_id, file_path, filename):
+    """Compress a merge file into the session's archive in the background, in arrival order"""
+    session = context.user_data.get('merge_session')
+    if session is None:
+        space = get_merge_space(context, user_id)
+        session = {
+            'space': space,
+            'archive': space.path("merge.zip"),
+            'task': None,
+            'count': 0,
+            'cancelled': False,
+            'incomplete': False,
+        }
+        context.user_data['merge_session'] = session
+    previous = session['task']
+    mode = 'w' if session['count'] == 0 else 'a'
+    session['count'] += 1
+    profile = get_profile(context)
+    timing = get_merge_metrics(context, user_id)
+    job_id = context.user_data['merge_job']
+    
+    async def append():
+        if previous:
+            await previous
+        if session['cancelled'] or session['incomplete'] or session['space'].closed:
+            return
+        # Never wait for disk here: /done waits for this task, and the bytes it would wait
+        # for may be our own. Without room the archive is simply rebuilt on /done
+        size = os.path.getsize(file_path)
+        if not session['space'].try_claim(size):
+            session['incomplete'] = True
+            return
+        # Appends share the workers fairly with everyone else; the job keeps collecting meanwhile
+        async with jobs.turn(job_id, user_id, size, state=None):
+            # The janitor may have reclaimed the session meanwhile - /done then builds from scratch
+            if not (session['cancelled'] or session['space'].closed):
+                with timing.stage('compress', size):
+                    await engine.zip(user_id, session['archive'], [(file_path, filename)], mode, profile)
+    
+    session['task'] = asyncio.create_task(append())
+
+def get_merge_space(context, user_id):
+    """Directory for the merge's archives; a fresh one if the janitor reclaimed the old one"""
+    space = context.user_data.get('merge_space')
+    if space is None or space.closed:
+        space = context.user_data['merge_space'] = storage.space(user_id)
+        space.on_expire = lambda: expire_merge(context, space)
+    return space
+
+def expire_merge(context, space):
+    """The janitor is reclaiming an abandoned merge - its inputs and job go with it"""
+    if context.user_data.get('merge_space') is space:
+        drop_merge_files(context, "expired")
+
+def get_merge_metrics(context, user_id):
+    return context.user_data.setdefault('merge_metrics', JobMetrics(metrics, 'merge', user_id))
+
+def reserve_merge_slot(context):
+    """Claim the next position in the merge before anything is awaited"""
+    slots = context.user_data.setdefault('merge_slots', [])
+    slot = asyncio.get_running_loop().create_future()
+    slots.append(slot)
+    return slots, slot
+
+def commit_merge_slots(context, user_id):
+    """Move finished downloads into the merge list, in the order the files were sent"""
+    slots = context.user_data.get('merge_slots', [])
+    while slots and slots[0].done():
+        entry = slots.pop(0).result()
+        if not entry:
+            continue  # download failed
+        entry['handled'] = True
+        if 'merge_job' not in context.user_data:
+            context.user_data['merge_job'] = jobs.create(
+                user_id, entry['chat_id'], 'merge', get_archiver(context).extension, get_profile(context),
+                state='collecting'
+            )
+        jobs.add_input(context.user_data['merge_job'], entry['id'], entry['name'], entry['size'])
+        # Every merge has a space from its first file on, so the janitor can reclaim it when abandoned
+        get_merge_space(context, user_id).touch()
+        context.user_data.setdefault('merge_files', []).append(entry['path'])
+        context.user_data.setdefault('merge_filenames', []).append(entry['name'])
+        context.user_data.setdefault('merge_ids', []).append(entry['id'])
+        if isinstance(get_archiver(context), ZipArchiver):
+            # ZIP can be appended to, other formats are built in one go on /done
+            add_to_merge_archive(context, user_id, entry['path'], entry['name'])
+
+async def settle_merge_slots(context, user_id):
+    """Wait for downloads that are still running and add them to the merge"""
+    slots = list(context.user_data.get('merge_slots', []))
+    if slots:
+        await asyncio.gather(*slots)
+    commit_merge_slots(context, user_id)
+
+def drop_merge_files(context, reason="cancelled"):
+    """Empty the merge list and hand its inputs back to the cache"""
+    unique_ids = list(context.user_data.get('merge_ids', []))
+    session = context.user_data.pop('merge_session', None)
+    space = context.user_data.pop('merge_space', None)
+    job_id = context.user_data.pop('merge_job', None)
+    if job_id is not None:
+        jobs.finish(job_id, reason)
+    timing = context.user_data.pop('merge_metrics', None)
+    if timing and timing.stages:
+        timing.finish(reason)
+    
+    # Downloads that finished but were waiting on an earlier one; running ones clean up after themselves
+    for slot in context.user_data.pop('merge_slots', []):
+        if slot.done() and slot.result():
+            slot.result()['handled'] = True
+            unique_ids.append(slot.result()['id'])
+    
+    def cleanup(task=None):
+        if task is not None and not task.cancelled():
+            task.exception()  # already reported to the user, if at all
+        for unique_id in unique_ids:
+            input_cache.release(unique_id)
+        if space:
+            space.close()
+    
+    # A background append may still be reading the inputs - let it finish first
+    if session and session['task'] and not session['task'].done():
+        session['cancelled'] = True
+        session['task'].add_done_callback(cleanup)
+    else:
+        cleanup()
+    context.user_data['merge_files'] = []
+    context.user_data['merge_filenames'] = []
+    context.user_data['merge_ids'] = []
+
+def drop_pending_single(context):
+    """Throw away a single file still waiting for its caption - nobody is going to send it any more"""
+    job_id = context.user_data.pop('pending_job', None)
+    space = context.user_data.pop('pending_space', None)
+    for key in ('pending_output', 'pending_file_id', 'pending_stream'):
+        context.user_data.pop(key, None)
+    timing = context.user_data.pop('pending_metrics', None)
+    if job_id is not None:
+        jobs.finish(job_id, "cancelled")
+    if timing:
+        timing.finish('cancelled')
+    if space:
+        space.close()
+
+def reset_session(context):
+    """Forget the current job but keep the user's settings"""
+    drop_merge_files(context)
+    drop_pending_single(context)
+    profile = context.user_data.get('profile')
+    context.user_data.clear()
+    if profile:
+        context.user_data['profile'] = profile
+
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command"""
     if update.effective_user.id not in ALLOWED_USERS:
@@ -56,7 +361,7 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.first_name
     await update.message.reply_text(
         f"👋 Hey {user}! I'm your **File Compressor Bot** 📦\n\n"
-        "I can compress your files to ZIP or RAR, or merge multiple files into one archive.\n\n"
+        "I can compress your files to ZIP, RAR, 7Z or TAR.GZ, or merge multiple files into one archive.\n\n"
         "Choose what you want to do:",
         reply_markup=get_main_menu(),
         parse_mode="Markdown"
@@ -82,72 +387,112 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     query = update.callback_query
     
-    if query.data == "mode_zip":
-        context.user_data['compress_mode'] = 'zip'
-        context.user_data['merge_mode'] = False
-        context.user_data['merge_files'] = []
-        context.user_data['merge_filenames'] = []
-        await query.edit_message_text(
-            "📇 *ZIP Mode*\n\n"
-            "Send me your files and I'll compress them to ZIP!",
-            reply_markup=get_zip_menu(),
-            parse_mode="Markdown"
-        )
-    elif query.data == "mode_rar":
-        context.user_data['compress_mode'] = 'rar'
-        context.user_data['merge_mode'] = False
-        context.user_data['merge_files'] = []
-        context.user_data['merge_filenames'] = []
-        await query.edit_message_text(
-            "📦 *RAR Mode*\n\n"
-            "Send me your files and I'll compress them to RAR!",
-            reply_markup=get_rar_menu(),
-            parse_mode="Markdown"
-        )
-    elif query.data == "mode_merge":
-        context.user_data['merge_mode'] = True
-        context.user_data['merge_files'] = []
-        context.user_data['merge_filenames'] = []
-        await query.edit_message_text(
-            "🔀 *Merge Mode*\n\n"
-            "Send me multiple files, then tap **Done** when finished!\n\n"
-            "The archive will be named after your first file.",
-            reply_markup=get_merge_menu(),
-            parse_mode="Markdown"
-        )
-    elif query.data == "cancel":
-        context.user_data.clear()
-        await query.edit_message_text(
-            "❌ Cancelled",
-            reply_markup=get_main_menu()
-        )
-    elif query.data == "back_menu":
-        await query.edit_message_text(
-            "📦 *File Compressor Bot*\n\n"
-            "Choose what you want to do:",
-            reply_markup=get_main_menu(),
-            parse_mode="Markdown"
-        )
-    elif query.data == "done_merge":
+    if query.data == "done_merge":
         await done_command(update, context)
+        return
+    
+    # Mode switches and cancel must not run in the middle of a build
+    async with downloads.lock(update.effective_user.id):
+        if query.data == "mode_zip":
+            context.user_data['compress_mode'] = 'zip'
+            context.user_data['merge_mode'] = False
+            drop_merge_files(context)
+            await query.edit_message_text(
+                "📇 *ZIP Mode*\n\n"
+                "Send me your files and I'll compress them to ZIP!",
+                reply_markup=get_zip_menu(),
+                parse_mode="Markdown"
+            )
+        elif query.data in ("mode_rar", "mode_7z") and not archivers[query.data[len("mode_"):]].available():
+            await query.answer(f"{query.data[len('mode_'):]} is not installed on the server.", show_alert=True)
+        elif query.data == "mode_rar":
+            context.user_data['compress_mode'] = 'rar'
+            context.user_data['merge_mode'] = False
+            drop_merge_files(context)
+            await query.edit_message_text(
+                "📦 *RAR Mode*\n\n"
+                "Send me your files and I'll compress them to RAR!",
+                reply_markup=get_rar_menu(),
+                parse_mode="Markdown"
+            )
+        elif query.data == "mode_7z":
+            context.user_data['compress_mode'] = '7z'
+            context.user_data['merge_mode'] = False
+            drop_merge_files(context)
+            await query.edit_message_text(
+                "🗜 *7Z Mode*\n\n"
+                "Send me your files and I'll compress them to 7Z!",
+                reply_markup=get_7z_menu(),
+                parse_mode="Markdown"
+            )
+        elif query.data == "mode_targz":
+            context.user_data['compress_mode'] = 'tar.gz'
+            context.user_data['merge_mode'] = False
+            drop_merge_files(context)
+            await query.edit_message_text(
+                "🗜 *TAR.GZ Mode*\n\n"
+                "Send me your files and I'll compress them to TAR.GZ using all CPU cores!",
+                reply_markup=get_targz_menu(),
+                parse_mode="Markdown"
+            )
+        elif query.data == "mode_merge":
+            context.user_data['merge_mode'] = True
+            drop_merge_files(context)
+            await query.edit_message_text(
+                "🔀 *Merge Mode*\n\n"
+                "Send me multiple files, then tap **Done** when finished!\n\n"
+                f"The {get_archiver(context).label} archive will be named after your first file.",
+                reply_markup=get_merge_menu(),
+                parse_mode="Markdown"
+            )
+        elif query.data == "profile_menu":
+            await query.edit_message_text(
+                "⚙️ *Speed vs Ratio*\n\n"
+                "⚡ *Fast* - quick deflate, bigger files\n"
+                "⚖️ *Balanced* - good default\n"
+                "🗜 *Max ratio* - LZMA/BZIP2, slowest\n\n"
+                "Photos, videos and archives are always stored as-is.",
+                reply_markup=get_profile_menu(get_profile(context)),
+                parse_mode="Markdown"
+            )
+        elif query.data.startswith("profile_") and query.data[len("profile_"):] in policy.PROFILES:
+            context.user_data['profile'] = query.data[len("profile_"):]
+            await query.edit_message_reply_markup(reply_markup=get_profile_menu(get_profile(context)))
+        elif query.data == "cancel":
+            reset_session(context)
+            await query.edit_message_text(
+                "❌ Cancelled",
+                reply_markup=get_main_menu()
+            )
+        elif query.data == "back_menu":
+            await query.edit_message_text(
+                "📦 *File Compressor Bot*\n\n"
+                "Choose what you want to do:",
+                reply_markup=get_main_menu(),
+                parse_mode="Markdown"
+            )
 
 async def done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Finish merge and ask for caption"""
     if update.effective_user.id not in ALLOWED_USERS:
         return
     
-    if 'merge_files' not in context.user_data or not context.user_data['merge_files']:
-        await update.message.reply_text("❌ No files to merge!")
-        return
-    
-    # Get first filename for the archive name
-    first_filename = context.user_data.get('merge_filenames', ['merged'])[0]
-    base_name = os.path.splitext(first_filename)[0]
-    context.user_data['archive_name'] = base_name
-    context.user_data['waiting_caption'] = True
+    async with downloads.lock(update.effective_user.id):
+        # Files still downloading belong to this merge too
+        await settle_merge_slots(context, update.effective_user.id)
+        
+        if 'merge_files' not in context.user_data or not context.user_data['merge_files']:
+            await update.effective_message.reply_text("❌ No files to merge!")
+            return
+        
+        # Get first filename for the archive name
+        first_filename = context.user_data.get('merge_filenames', ['merged'])[0]
+        base_name = os.path.splitext(first_filename)[0]
+        context.user_data['archive_name'] = base_name
+        context.user_data['waiting_caption'] = True
     
     # Ask for caption
-    await update.message.reply_text(
+    await update.effective_message.reply_text(
         "📝 *Enter caption*\n\n"
         "Reply with your caption, or send /skip to continue without caption.",
         parse_mode="Markdown",
@@ -174,18 +519,26 @@ async def handle_caption(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     caption = update.message.text
-    if caption.startswith('/'):
+    if has_pending_single(context):
+        await send_pending_single(update, context, caption)
+    elif caption.startswith('/'):
         await create_and_send_archive(update, context, None)
     else:
         await create_and_send_archive(update, context, caption)
 
 async def create_and_send_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, caption: str = None):
     """Create and send the archive"""
+    async with downloads.lock(update.effective_user.id):
+        await settle_merge_slots(context, update.effective_user.id)
+        await build_and_send_archive(update, context, caption)
+
+async def build_and_send_archive(update: Update, context: ContextTypes.DEFAULT_TYPE, caption: str = None):
+    """Compress the merge files and upload the archive; the caller holds the user's lock"""
     user_id = update.effective_user.id
     files = context.user_data.get('merge_files', [])
     
     if not files:
-        await update.message.reply_text("❌ No files!", reply_markup=get_main_menu())
+        await update.effective_message.reply_text("❌ No files!", reply_markup=get_main_menu())
         return
     
     # Determine archive name
@@ -193,76 +546,131 @@ async def create_and_send_archive(update: Update, context: ContextTypes.DEFAULT_
         base_name = context.user_data.get('archive_name', 'merged')
     else:
         # Single file - use original name
-        base_name = os.path.splitext(os.path.basename(files[0]))[0]
+        base_name = os.path.splitext(context.user_data.get('merge_filenames', files)[0])[0]
+    
+    archiver = get_archiver(context)
+    archive_name = f"{base_name}.{archiver.extension}"
+    output_path = get_merge_space(context, user_id).path(f"{uuid.uuid4().hex}.{archiver.extension}")
+    filenames = context.user_data.get('merge_filenames', files)
     
-    output_path = f"{DOWNLOAD_DIR}{base_name}.zip"
+    # Same inputs, names, format and profile as an earlier archive - just resend it
+    result_key = ResultCache.key(
+        context.user_data.get('merge_ids', []), filenames, archiver.extension, get_profile(context)
+    )
+    file_id = result_cache.get(result_key)
+    
+    # The caption is known now, so a restart can finish the job on its own
+    job_id = context.user_data.get('merge_job')
+    total_bytes = sum(os.path.getsize(f) for f in files)
+    timing = get_merge_metrics(context, user_id)
+    output_size = 0
+    if job_id is not None:
+        jobs.update(
+            job_id, state='downloaded', name=archive_name, caption=caption,
+            fmt=archiver.extension, profile=get_profile(context)
+        )
     
     # Send initial progress
-    progress_msg = await update.message.reply_text(
+    progress_msg = await update.effective_message.reply_text(
         f"🔄 *Creating archive...*\n\n"
         f"Files: {len(files)}",
         parse_mode="Markdown"
     )
+    progress = ProgressReporter(progress_msg, PROGRESS_INTERVAL)
     
     try:
-        # Create ZIP
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for i, f in enumerate(files):
-                filename = os.path.basename(context.user_data.get('merge_filenames', [f]*len(files))[i])
-                zipf.write(f, filename)
-                
-                # Calculate progress
-                progress = (i + 1) / len(files)
-                bars = int(progress * 20)
-                progress_bar = "█" * bars + "░" * (20 - bars)
-                
-                await progress_msg.edit_text(
-                    f"🔄 *Creating archive...*\n\n"
-                    f"📁 Progress: {i+1}/{len(files)}\n"
-                    f"```{progress_bar}```",
-                    parse_mode="Markdown"
+        # Files were compressed as they arrived - just wait for the last ones
+        session = context.user_data.get('merge_session')
+        built = False
+        if not file_id and session and session['count'] == len(files) and not session['space'].closed:
+            progress.start("🔄 *Finishing archive...*", detail=f"📁 Files: {len(files)}")
+            try:
+                await session['task']
+                output_path = session['archive']
+                built = not (session['incomplete'] or session['space'].closed)
+            except Exception:
+                # Something went wrong in the background - rebuild from scratch below
+                pass
+        
+        if not (file_id or built):
+            entries = [(f, os.path.basename(filenames[i])) for i, f in enumerate(files)]
+            progress.start(
+                "🔄 *Waiting for a free worker...*", detail=f"📁 Files: {len(files)} · {archiver.label}"
+            )
+            # The half-built incremental archive is useless now; claiming on top of its
+            # reservation could wait forever on our own bytes
+            space = get_merge_space(context, user_id)
+            if session and session['space'] is space:
+                try:
+                    os.remove(session['archive'])
+                except OSError:
+                    pass
+            space.release()
+            await space.claim(total_bytes)
+            async with jobs.turn(job_id, user_id, total_bytes):
+                progress.start(
+                    "🔄 *Creating archive...*", total_bytes, detail=f"📁 Files: {len(files)} · {archiver.label}"
                 )
+                with timing.stage('compress', total_bytes):
+                    await archiver.create(user_id, output_path, entries, get_profile(context), progress.update)
         
         # Send file with caption
-        if caption:
-            await progress_msg.edit_text(
-                f"✅ *Done!*\n\n"
-                f"📦 `{base_name}.zip`\n"
-                f"📁 Files: {len(files)}",
-                parse_mode="Markdown"
-            )
-            await update.message.reply_document(
-                document=open(output_path, 'rb'),
-                caption=f"📦 *{base_name}.zip*\n\n{caption}",
-                parse_mode="Markdown"
-            )
+        full_caption = f"📦 *{archive_name}*\n\n{caption}" if caption else None
+        if file_id:
+            try:
+                await update.effective_message.reply_document(document=file_id, caption=full_caption, parse_mode="Markdown")
+            except BadRequest:
+                # Telegram dropped the cached file - the next /done rebuilds it
+                result_cache.forget(result_key)
+                jobs.update(job_id, state='collecting')
+                await progress.finish("♻️ Cached archive expired, send /done again to rebuild it.")
+                return
         else:
-            await progress_msg.edit_text(
-                f"✅ *Done!*\n\n"
-                f"📦 `{base_name}.zip`\n"
-                f"📁 Files: {len(files)}",
-                parse_mode="Markdown"
-            )
-            await update.message.reply_document(document=open(output_path, 'rb'))
+            jobs.update(job_id, state='uploading', output=output_path)
+            output_size = os.path.getsize(output_path)
+            progress.start("📤 *Uploading...*", output_size, detail=f"📦 `{archive_name}`")
+            with timing.stage('upload', output_size):
+                sent = await upload_document(
+                    update.effective_chat.id, output_path, filename=archive_name, caption=full_caption,
+                    progress=progress.update
+                )
+            remember_result(result_key, sent)
+            os.remove(output_path)
+        await progress.finish(
+            f"✅ *Done!*\n\n"
+            f"📦 `{archive_name}`\n"
+            f"📁 Files: {len(files)}"
+        )
+        jobs.finish(context.user_data.pop('merge_job'))
+        context.user_data.pop('merge_metrics', None)
+        timing.finish('cached' if file_id else 'done', total_bytes, output_size)
         
         # Show completion menu
-        await update.message.reply_text(
+        await update.effective_message.reply_text(
             "🔄 Ready for more!",
             reply_markup=get_main_menu()
         )
         
-        # Cleanup
-        for f in files:
-            if os.path.exists(f):
-                os.remove(f)
-        os.remove(output_path)
-        
-        # Reset state
-        context.user_data.clear()
+        # Reset state - inputs go back to the cache
+        reset_session(context)
         
+    except EngineBusy:
+        await progress.finish("⏳ Bot is busy right now, send /done again in a minute.", parse_mode=None)
+        jobs.update(job_id, state='collecting')
+    except ArchiverError as e:
+        await progress.finish(f"❌ {e}", parse_mode=None)
+        if 'merge_job' in context.user_data:
+            jobs.finish(context.user_data.pop('merge_job'), str(e))
+        context.user_data.pop('merge_metrics', None)
+        timing.finish('failed')
+        reset_session(context)
     except Exception as e:
-        await progress_msg.edit_text(f"❌ Error: {str(e)}")
-        context.user_data.clear()
+        await progress.finish(f"❌ Error: {str(e)}", parse_mode=None)
+        if 'merge_job' in context.user_data:
+            jobs.finish(context.user_data.pop('merge_job'), str(e))
+        context.user_data.pop('merge_metrics', None)
+        timing.finish('failed')
+        reset_session(context)
 
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming documents"""
@@ -273,93 +681,214 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not document:
         return
     
-    file = await context.bot.get_file(document.file_id)
+    # Known sizes are turned away before anything is downloaded
+    if document.file_size and document.file_size > MAX_FILE_SIZE:
+        await update.message.reply_text(
+            f"❌ *File too big!*\n\n"
+            f"Max size: {MAX_FILE_SIZE/1024/1024:.0f}MB\n"
+            f"Your file: {document.file_size/1024/1024:.1f}MB",
+            parse_mode="Markdown"
+        )
+        return
+    
+    # Take our place in the merge before the first await, so downloads that finish
+    # out of order still end up in the order the files were sent
+    merge_slot = reserve_merge_slot(context) if context.user_data.get('merge_mode') else None
+    
+    # Already compressed this exact file before - offer the uploaded archive again
+    compress_mode = context.user_data.get('compress_mode', 'zip')
+    if not context.user_data.get('merge_mode'):
+        result_key = ResultCache.key([document.file_unique_id], [document.file_name], compress_mode, get_profile(context))
+        file_id = result_cache.get(result_key)
+        if file_id:
+            base_name = os.path.splitext(document.file_name)[0]
+            drop_pending_single(context)
+            context.user_data['pending_file_id'] = file_id
+            context.user_data['pending_key'] = result_key
+            context.user_data['pending_name'] = f"{base_name}.{compress_mode}"
+            context.user_data['waiting_caption'] = True
+            await update.message.reply_text(
+                f"⚡ *Ready!*\n\n"
+                f"📦 `{base_name}.{compress_mode}`\n\n"
+                "📝 *Reply with caption* or tap Skip.",
+                reply_markup=get_skip_single_menu(),
+                parse_mode="Markdown"
+            )
+            return
+    
+    # Streaming mode: nothing is downloaded until we know the caption
+    if STREAMING and not context.user_data.get('merge_mode') and compress_mode == 'zip':
+        base_name = os.path.splitext(document.file_name)[0]
+        drop_pending_single(context)
+        context.user_data['pending_stream'] = {
+            'file_id': document.file_id, 'filename': document.file_name, 'size': document.file_size
+        }
+        context.user_data['pending_key'] = result_key
+        context.user_data['pending_name'] = f"{base_name}.zip"
+        context.user_data['waiting_caption'] = True
+        await update.message.reply_text(
+            f"📦 `{base_name}.zip`\n\n"
+            "📝 *Reply with caption* or tap Skip.",
+            reply_markup=get_skip_single_menu(),
+            parse_mode="Markdown"
+        )
+        return
+    
     user_id = update.effective_user.id
     original_filename = document.file_name
-    file_path = os.path.join(DOWNLOAD_DIR, f"{user_id}_{document.file_id}_{original_filename}")
+    unique_id = document.file_unique_id
+    # Merge downloads count towards the merge, a single file is a job of its own
+    timing = get_merge_metrics(context, user_id) if merge_slot is not None else JobMetrics(metrics, 'single', user_id)
     
-    # Send initial progress
-    progress_msg = await update.message.reply_text(
-        f"📥 *Downloading...*\n\n"
-        f"📄 `{original_filename}`",
-        parse_mode="Markdown"
-    )
+    async def download(path):
+        async with downloads.slot(user_id):
+            progress.start(f"📥 *Downloading...*\n\n📄 `{original_filename}`", document.file_size)
+            with timing.stage('download', document.file_size or 0):
+                file = await context.bot.get_file(document.file_id)
+                await download_to_path(file, path, progress.update, STREAM_CHUNK_SIZE, file_client)
     
+    progress = None
+    file_path = None
+    job_id = None
+    space = None
+    # Everything after the merge slot was taken runs in here, so the finally always resolves it
     try:
-        await file.download_to_drive(file_path)
+        # Send initial progress
+        progress_msg = await update.message.reply_text(
+            f"📥 *Downloading...*\n\n"
+            f"📄 `{original_filename}`",
+            parse_mode="Markdown"
+        )
+        progress = ProgressReporter(progress_msg, PROGRESS_INTERVAL)
+        
+        # Forwarded copies of the same document come straight from the cache
+        file_path, _ = await input_cache.fetch(unique_id, download)
         file_size = os.path.getsize(file_path)
         
         if file_size > MAX_FILE_SIZE:
-            await progress_msg.edit_text(
+            await progress.finish(
                 f"❌ *File too big!*\n\n"
-                f"Max size: 50MB\n"
-                f"Your file: {file_size/1024/1024:.1f}MB",
-                parse_mode="Markdown"
+                f"Max size: {MAX_FILE_SIZE/1024/1024:.0f}MB\n"
+                f"Your file: {file_size/1024/1024:.1f}MB"
             )
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            input_cache.release(unique_id)
+            input_cache.discard(unique_id)
+            if merge_slot is None:
+                timing.finish('rejected')
             return
         
-        # Check mode
-        if context.user_data.get('merge_mode'):
-            context.user_data.setdefault('merge_files', []).append(file_path)
-            context.user_data.setdefault('merge_filenames', []).append(original_filename)
-            count = len(context.user_data['merge_files'])
-            await progress_msg.edit_text(
+        # Check mode - merge inputs stay referenced until the session ends
+        if merge_slot is not None:
+            slots, slot = merge_slot
+            entry = {
+                'path': file_path, 'name': original_filename, 'id': unique_id, 'size': file_size,
+                'chat_id': update.effective_chat.id, 'handled': False,
+            }
+            slot.set_result(entry)
+            async with downloads.lock(user_id):
+                commit_merge_slots(context, user_id)
+                if not entry['handled'] and context.user_data.get('merge_slots') is not slots:
+                    # The merge was cancelled or finished while we were downloading
+                    entry['handled'] = True
+                    input_cache.release(unique_id)
+                    await progress.finish("❌ Merge was closed before this file arrived.", parse_mode=None)
+                    return
+            count = len(context.user_data.get('merge_files', [])) + len(context.user_data.get('merge_slots', []))
+            await progress.finish(
                 f"✅ *File added!*\n\n"
                 f"📄 `{original_filename}`\n"
                 f"📁 Total: *{count}* files",
-                reply_markup=get_merge_menu(),
-                parse_mode="Markdown"
+                reply_markup=get_merge_menu()
             )
             return
         
-        compress_mode = context.user_data.get('compress_mode', 'zip')
-        
         # Single file - keep original name
         base_name = os.path.splitext(original_filename)[0]
+        archiver = get_archiver(context)
+        ext = archiver.extension
         
-        await progress_msg.edit_text(
+        progress.start(
             f"📦 *Compressing...*\n\n"
             f"📄 `{original_filename}`\n"
-            f"Format: {compress_mode.upper()}",
-            parse_mode="Markdown"
+            f"Format: {archiver.label}",
+            file_size
         )
         
-        # Compress
-        if compress_mode == 'rar':
-            output_path = file_path.replace(os.path.splitext(file_path)[1], '.rar')
-            with rarfile.RarFile(output_path, 'w') as rarf:
-                rarf.write(file_path, original_filename)
-        else:
-            output_path = file_path.replace(os.path.splitext(file_path)[1], '.zip')
-            with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zipf.write(file_path, original_filename)
+        # Compress once there is disk space and the queue gives us a worker
+        space = storage.space(user_id)
+        output_path = space.path(f"{unique_id}.{ext}")
+        job_id = jobs.create(
+            user_id, update.effective_chat.id, 'single', ext, get_profile(context),
+            inputs=[(unique_id, original_filename)], size=file_size, name=f"{base_name}.{ext}"
+        )
+        entries = [(file_path, original_filename)]
+        # Small ZIPs are built in memory and wait there for their caption; nothing else touches the disk
+        in_memory = isinstance(archiver, ZipArchiver) and file_size <= SPOOL_MAX
+        if not in_memory:
+            await space.claim(file_size)
+        async with jobs.turn(job_id, user_id, file_size):
+            with timing.stage('compress', file_size):
+                if in_memory:
+                    data = await archiver.create_bytes(user_id, entries, get_profile(context), progress.update)
+                else:
+                    await archiver.create(user_id, output_path, entries, get_profile(context), progress.update)
+        output = space.hold(data) if in_memory else space.keep(output_path)
+        jobs.update(job_id, state='ready', output=output.path)
         
-        # Ask for caption
-        context.user_data['pending_file'] = output_path
-        context.user_data['pending_name'] = f"{base_name}.{'zip' if compress_mode == 'zip' else 'rar'}"
-        context.user_data['waiting_caption'] = True
+        # Ask for caption - this file replaces one that finished earlier and is still waiting
+        async with downloads.lock(user_id):
+            drop_pending_single(context)
+            context.user_data['pending_job'] = job_id
+            context.user_data['pending_metrics'] = timing
+            context.user_data['pending_space'] = space
+            context.user_data['pending_output'] = output
+            context.user_data['pending_key'] = result_key
+            context.user_data['pending_name'] = f"{base_name}.{ext}"
+            context.user_data['waiting_caption'] = True
         
-        ext = 'zip' if compress_mode == 'zip' else 'rar'
-        await progress_msg.edit_text(
+        await progress.finish(
             f"✅ *Compressed!*\n\n"
             f"📦 `{base_name}.{ext}`\n\n"
             "📝 *Reply with caption* or tap Skip.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("⏭️ Skip", callback_data="skip_caption_single", bg_color=Update.BUTTON_COLOR_SECONDARY)]
-            ]),
-            parse_mode="Markdown"
+            reply_markup=get_skip_single_menu()
         )
         
-        # Cleanup original
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        # Done with the original, the cache decides when to drop it
+        input_cache.release(unique_id)
         
+    except EngineBusy:
+        await progress.finish("⏳ Bot is busy right now, please send the file again in a minute.", parse_mode=None)
+        if job_id is not None:
+            jobs.finish(job_id, "busy")
+        if merge_slot is None:
+            timing.finish('busy')
+        if file_path:
+            input_cache.release(unique_id)
+    except ArchiverError as e:
+        await progress.finish(f"❌ {e}", parse_mode=None)
+        if job_id is not None:
+            jobs.finish(job_id, str(e))
+        if merge_slot is None:
+            timing.finish('failed')
+        input_cache.release(unique_id)
     except Exception as e:
-        await progress_msg.edit_text(f"❌ Error: {str(e)}")
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        if progress is not None:
+            await progress.finish(f"❌ Error: {str(e)}", parse_mode=None)
+        if job_id is not None:
+            jobs.finish(job_id, str(e))
+        if merge_slot is None:
+            timing.finish('failed')
+        if file_path:
+            input_cache.release(unique_id)
+    finally:
+        # An archive that never reached the caption prompt is thrown away
+        if space is not None and context.user_data.get('pending_space') is not space:
+            space.close()
+        # Failed or rejected merge files must not hold up the ones sent after them
+        if merge_slot is not None and not merge_slot[1].done():
+            merge_slot[1].set_result(None)
+            async with downloads.lock(user_id):
+                commit_merge_slots(context, user_id)
 
 async def skip_caption_single_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Skip caption for single file"""
@@ -368,34 +897,288 @@ async def skip_caption_single_callback(update: Update, context: ContextTypes.DEF
     
     query = update.callback_query
     await query.answer()
-    
-    output_path = context.user_data.pop('pending_file', None)
+    await send_pending_single(update, context, None)
+
+async def skip_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /skip for both single files and merges"""
+    if has_pending_single(context):
+        await send_pending_single(update, context, None)
+    else:
+        await create_and_send_archive(update, context, None)
+
+async def send_pending_single(update: Update, context: ContextTypes.DEFAULT_TYPE, caption: str = None):
+    """Send the single file that was waiting for its caption"""
+    message = update.effective_message
+    output = context.user_data.pop('pending_output', None)
+    space = context.user_data.pop('pending_space', None)
+    job_id = context.user_data.pop('pending_job', None)
+    timing = context.user_data.pop('pending_metrics', None)
+    stream = context.user_data.pop('pending_stream', None)
+    file_id = context.user_data.pop('pending_file_id', None)
+    result_key = context.user_data.pop('pending_key', None)
     name = context.user_data.pop('pending_name', 'archive')
     context.user_data.pop('waiting_caption', None)
+    full_caption = f"📦 *{name}*\n\n{caption}" if caption else None
     
-    if output_path and os.path.exists(output_path):
-        await update.message.reply_document(document=open(output_path, 'rb'))
-        os.remove(output_path)
+    if file_id:
+        try:
+            await message.reply_document(document=file_id, caption=full_caption, parse_mode="Markdown")
+        except BadRequest:
+            result_cache.forget(result_key)
+            await message.reply_text("♻️ Cached archive expired, please send the file again.")
+    elif stream:
+        progress_msg = await message.reply_text(
+            f"🔄 *Streaming...*\n\n"
+            f"📄 `{stream['filename']}`",
+            parse_mode="Markdown"
+        )
+        progress = ProgressReporter(progress_msg, PROGRESS_INTERVAL)
+        progress.start(f"🔄 *Streaming...*\n\n📄 `{stream['filename']}`", stream.get('size'))
+        # Download, compress and upload overlap, so they are timed as one stage
+        timing = JobMetrics(metrics, 'stream', update.effective_user.id)
+        try:
+            async with engine.slot(update.effective_user.id), downloads.slot(update.effective_user.id):
+                file = await context.bot.get_file(stream['file_id'])
+                with timing.stage('stream', stream.get('size') or 0):
+                    sent = await stream_zip_upload(
+                        context.bot, file.file_path, message.chat_id, stream['filename'], name,
+                        caption=full_caption, parse_mode="Markdown",
+                        chunk_size=STREAM_CHUNK_SIZE, buffer_chunks=STREAM_BUFFER_CHUNKS, max_bytes=MAX_FILE_SIZE,
+                        client=file_client, upload_client=stream_upload_client,
+                        profile=get_profile(context), progress=progress.update
+                    )
+            remember_result(result_key, sent)
+            timing.finish('done', stream.get('size') or 0, sent.document.file_size if sent and sent.document else 0)
+            await progress.finish(f"✅ *Done!*\n\n📦 `{name}`")
+        except EngineBusy:
+            timing.finish('busy')
+            await progress.finish("⏳ Bot is busy right now, please send the file again in a minute.", parse_mode=None)
+        except Exception as e:
+            timing.finish('failed')
+            await progress.finish(f"❌ Error: {str(e)}", parse_mode=None)
+    elif output is not None and output.closed:
+        # Waited longer than STORAGE_TTL, the janitor took it
+        space.close()
+        if job_id is not None:
+            jobs.finish(job_id, "expired")
+        if timing:
+            timing.finish('expired')
+        await message.reply_text("♻️ This archive expired, please send the file again.")
+    elif output is not None:
+        if job_id is not None:
+            jobs.update(job_id, state='uploading', caption=caption)
+        timing = timing or JobMetrics(metrics, 'single', update.effective_user.id)
+        detail = f"📦 `{name}` · {format_size(output.size)}"
+        progress_msg = await message.reply_text(f"📤 *Uploading...*\n\n{detail}", parse_mode="Markdown")
+        progress = ProgressReporter(progress_msg, PROGRESS_INTERVAL)
+        progress.start("📤 *Uploading...*", output.size, detail=f"📦 `{name}`")
+        try:
+            with timing.stage('upload', output.size):
+                sent = await upload_document(
+                    message.chat_id, output, filename=name, caption=full_caption, progress=progress.update
+                )
+        except Exception as e:
+            if job_id is not None:
+                jobs.finish(job_id, str(e))
+            timing.finish('failed')
+            await progress.finish(f"❌ Error: {str(e)}", parse_mode=None)
+            return
+        finally:
+            space.close()
+        remember_result(result_key, sent)
+        if job_id is not None:
+            jobs.finish(job_id)
+        timing.finish('done', timing.bytes.get('compress', 0), output.size)
+        await progress.finish(f"✅ *Done!*\n\n📦 `{name}`")
     
-    await update.message.reply_text(
+    await message.reply_text(
         "🔄 Ready for more!",
         reply_markup=get_main_menu()
     )
 
-def main():
-    """Start the bot"""
-    application = Application.builder().token(BOT_TOKEN).build()
+def has_pending_single(context):
+    return any(key in context.user_data for key in ('pending_output', 'pending_stream', 'pending_file_id'))
+
+async def upload_document(chat_id, path, filename=None, caption=None, progress=None):
+    """Send a file from disk, or a Spool, through the upload pool; progress(bytes_sent) follows the upload"""
+    
+    async def send(f):
+        if progress:
+            f = ProgressReader(f, progress)
+        # Handed over unread, so the request streams it in chunks instead of loading it whole
+        document = InputFile(f, filename=filename, read_file_handle=False)
+        return await uploader.send_document(chat_id, document=document, caption=caption, parse_mode="Markdown")
+    
+    if isinstance(path, Spool):
+        if path.path is None:
+            return await send(path.open())
+        path = path.path
+    if LOCAL_BOT_API:
+        # The local server reads the file itself and names it after the path, so link it under its real name
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(path)) as stage:
+            named = os.path.join(stage, filename or os.path.basename(path))
+            os.link(path, named)
+            return await uploader.send_document(
+                chat_id, document=pathlib.Path(named), caption=caption, parse_mode="Markdown"
+            )
+    with open(path, 'rb') as f:
+        return await send(f)
+
+def remember_result(result_key, sent):
+    """Store the file_id of an uploaded archive so the same request is answered instantly"""
+    if result_key and sent and sent.document:
+        result_cache.put(result_key, sent.document.file_id)
+
+async def queue_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show queue depth and wait times, for sizing JOB_SLOTS"""
+    if update.effective_user.id not in ALLOWED_USERS:
+        return
+    
+    stats = jobs.stats()
+    states = stats['states']
+    await update.message.reply_text(
+        f"📊 *Queue*\n\n"
+        f"⏳ Waiting: {stats['depth']} (oldest {stats['oldest_wait']:.0f}s)\n"
+        f"⚙️ Running: {stats['running']}/{stats['slots']}\n"
+        f"🕒 Wait: avg {stats['avg_wait']:.1f}s · p95 {stats['p95_wait']:.1f}s\n"
+        f"📁 Collecting: {states['collecting']} · Ready: {states['ready']} · Uploading: {states['uploading']}\n"
+        f"✅ Done: {states['done']} · ❌ Failed: {states['failed']}",
+        parse_mode="Markdown"
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show where the time goes: per-stage timings and speed, compression ratio and event-loop lag"""
+    if update.effective_user.id not in ALLOWED_USERS:
+        return
+    
+    lines = ["📈 *Stats*", ""]
+    for stage, histogram in sorted(metrics.stage_seconds.items()):
+        size = metrics.stage_bytes[stage]
+        speed = f" · {size / histogram.sum / 1024 / 1024:.1f} MB/s" if size and histogram.sum else ""
+        p95 = histogram.quantile(0.95)
+        # Past the last bucket all we know is a lower bound
+        p95 = f"≤{p95}s" if p95 != float('inf') else f">{histogram.buckets[-1]}s"
+        lines.append(f"*{stage}*: {histogram.count}× · avg {histogram.mean:.2f}s · p95 {p95}{speed}")
+    if metrics.ratio.count:
+        lines.append(f"🗜 Ratio: avg {metrics.ratio.mean:.2f}")
+    lag = list(metrics.recent_lag)
+    if lag:
+        lines.append(f"⏱ Loop lag (last min): avg {sum(lag) / len(lag) * 1000:.1f}ms · max {max(lag) * 1000:.1f}ms")
+    finished = sum(metrics.jobs.values())
+    lines.append(f"✅ Jobs: {finished} · 💾 Input cache: {input_cache.hits} hits / {input_cache.misses} misses")
+    await update.message.reply_text("\n".join(lines), parse_mode="Markdown")
+
+def clean_download_dir():
+    """Remove archives and rar/7z staging folders a previous run left behind"""
+    for name in os.listdir(DOWNLOAD_DIR):
+        path = os.path.join(DOWNLOAD_DIR, name)
+        if os.path.isdir(path) and name.startswith('tmp'):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isfile(path) and '_' in name and name.split('_', 1)[0].isdigit():
+            os.remove(path)
+
+async def resume_merge(bot, job):
+    """Build and send a merge whose caption was given before the restart"""
+    paths = []
+    timing = JobMetrics(metrics, 'resume', job['user_id'])
+    space = storage.space(job['user_id'])
+    try:
+        for unique_id, _ in job['inputs']:
+            path = input_cache.acquire(unique_id)
+            if path is None:
+                raise ArchiverError("an input file is no longer cached")
+            paths.append(path)
+        archiver = archivers[job['fmt']]
+        output_path = space.path(f"{uuid.uuid4().hex}.{archiver.extension}")
+        entries = [(path, os.path.basename(arcname)) for path, (_, arcname) in zip(paths, job['inputs'])]
+        await space.claim(job['size'])
+        async with jobs.turn(job['id'], job['user_id'], job['size']):
+            with timing.stage('compress', job['size']):
+                await archiver.create(job['user_id'], output_path, entries, job['profile'])
+        jobs.update(job['id'], state='uploading', output=output_path)
+        full_caption = f"📦 *{job['name']}*\n\n{job['caption']}" if job['caption'] else None
+        output_size = os.path.getsize(output_path)
+        with timing.stage('upload', output_size):
+            sent = await upload_document(job['chat_id'], output_path, filename=job['name'], caption=full_caption)
+        remember_result(
+            ResultCache.key([i[0] for i in job['inputs']], [i[1] for i in job['inputs']], job['fmt'], job['profile']),
+            sent
+        )
+        jobs.finish(job['id'])
+        timing.finish('done', job['size'], output_size)
+    except Exception as e:
+        jobs.finish(job['id'], str(e))
+        timing.finish('failed')
+        await bot.send_message(
+            job['chat_id'], f"❌ The bot restarted and could not finish {job['name']}: {e}\nPlease send the files again."
+        )
+    finally:
+        space.close()
+        for unique_id, _ in job['inputs'][:len(paths)]:
+            input_cache.release(unique_id)
+
+async def recover_jobs(application):
+    """Resume merges that only had to be built and sent, drop everything else a restart interrupted"""
+    clean_download_dir()
+    for job in jobs.active():
+        if job['kind'] == 'merge' and job['state'] in ('downloaded', 'compressing', 'uploading') and job['name']:
+            jobs.update(job['id'], state='downloaded')
+            application.create_task(resume_merge(application.bot, job))
+            continue
+        jobs.finish(job['id'], "interrupted by restart")
+        what = f"`{job['name']}`" if job['name'] else "your files"
+        try:
+            await application.bot.send_message(
+                job['chat_id'], f"⚠️ The bot restarted while working on {what}, please send them again.",
+                parse_mode="Markdown"
+            )
+        except Exception:
+            pass  # the user may have blocked the bot
+
+async def post_init(application):
+    """Recover interrupted jobs and start the metrics endpoint, loop-lag sampler and storage janitor"""
+    await uploader.initialize()
+    await recover_jobs(application)
+    # The application isn't running yet, so keep a reference ourselves
+    application.bot_data['lag_sampler'] = asyncio.create_task(metrics.sample_loop_lag())
+    application.bot_data['janitor'] = asyncio.create_task(storage.janitor())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await metrics.serve(METRICS_HOST, METRICS_PORT)
+
+async def post_shutdown(application):
+    """Stop the background tasks and metrics endpoint, then close the upload and download pools"""
+    tasks = [application.bot_data.pop(name) for name in ('lag_sampler', 'janitor') if name in application.bot_data]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    server = application.bot_data.pop('metrics_server', None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    await uploader.shutdown()
+    await file_client.aclose()
+    await stream_upload_client.aclose()
+
+def build_application():
+    """Create the Application with all handlers registered"""
+    application = (
+        Application.builder().token(BOT_TOKEN).base_url(BOT_API_URL).base_file_url(BOT_FILE_URL)
+        .request(api_request).get_updates_request(updates_request).local_mode(LOCAL_BOT_API)
+        .concurrent_updates(CONCURRENT_UPDATES).post_init(post_init).post_shutdown(post_shutdown).build()
+    )
     
     # Commands
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("done", done_command))
-    application.add_handler(CommandHandler("skip", lambda u, c: create_and_send_archive(u, c, None)))
+    application.add_handler(CommandHandler("skip", skip_command))
+    application.add_handler(CommandHandler("queue", queue_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     
-    # Buttons
+    # Buttons - specific patterns first, "skip_caption" would also match "skip_caption_single"
+    application.add_handler(CallbackQueryHandler(skip_caption_single_callback, pattern="^skip_caption_single$"))
+    application.add_handler(CallbackQueryHandler(skip_caption_callback, pattern="^skip_caption$"))
     application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(CallbackQueryHandler(skip_caption_callback, pattern="skip_caption"))
-    application.add_handler(CallbackQueryHandler(skip_caption_single_callback, pattern="skip_caption_single"))
     
     # Documents
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
@@ -403,8 +1186,27 @@ def main():
     # Caption handling
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_caption))
     
+    return application
+
+def main():
+    """Start the bot"""
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s", level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per API call drowns the job logs
+    application = build_application()
     print("🤖 Bot started!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    try:
+        if WEBHOOK_URL:
+            # Telegram pushes updates to us, nothing waits on a poll
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=ALLOWED_UPDATES, max_connections=CONCURRENT_UPDATES
+            )
+        else:
+            application.run_polling(allowed_updates=ALLOWED_UPDATES, timeout=POLL_TIMEOUT)
+    finally:
+        engine.shutdown()
+        jobs.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,181 @@
+"""
+Caches for the File Compressor Bot.
+Downloaded inputs are kept on disk keyed by Telegram's file_unique_id, so forwarded
+copies of the same document never hit the network twice. Uploaded archives are
+remembered by their file_id, so the same request is answered without any work.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+
+class InputCache:
+    """Disk cache of downloaded documents with a byte budget, LRU eviction and ref counting"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # unique_id -> size, least recently used first
+        self._refs = {}
+        self._loading = {}
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    @property
+    def size(self):
+        return self._size
+
+    def path(self, unique_id):
+        return os.path.join(self.directory, unique_id)
+
+    def _scan(self):
+        """Pick up files left by a previous run, oldest access first"""
+        found = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.part'):
+                os.remove(path)
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._size += size
+        self._evict()
+
+    def acquire(self, unique_id):
+        """Return the cached path and hold a reference to it, or None on a miss"""
+        if unique_id not in self._entries:
+            return None
+        self._entries.move_to_end(unique_id)
+        self._refs[unique_id] = self._refs.get(unique_id, 0) + 1
+        path = self.path(unique_id)
+        os.utime(path)  # keep LRU order across restarts
+        return path
+
+    def release(self, unique_id):
+        """Drop a reference taken by acquire() or fetch()"""
+        refs = self._refs.get(unique_id, 0) - 1
+        if refs > 0:
+            self._refs[unique_id] = refs
+        else:
+            self._refs.pop(unique_id, None)
+        self._evict()
+
+    def discard(self, unique_id):
+        """Remove an entry right away if nobody is using it"""
+        if unique_id in self._entries and not self._refs.get(unique_id):
+            self._remove(unique_id)
+
+    async def fetch(self, unique_id, download):
+        """Return (path, hit) for unique_id, calling await download(path) on a miss.
+
+        The caller owns one reference and must release() it when done.
+        """
+        path = self.acquire(unique_id)
+        if path:
+            self.hits += 1
+            return path, True
+
+        # Someone else is already downloading this file - wait for them. If theirs failed,
+        # only one of the waiters starts over; the others wait for that one in turn
+        while unique_id in self._loading:
+            await asyncio.shield(self._loading[unique_id])
+            path = self.acquire(unique_id)
+            if path:
+                self.hits += 1
+                return path, True
+
+        self.misses += 1
+        path = self.path(unique_id)
+        part = f"{path}.part"
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[unique_id] = loading
+        try:
+            await download(part)
+            os.replace(part, path)
+            size = os.path.getsize(path)
+            self._entries[unique_id] = size
+            self._size += size
+            self._refs[unique_id] = self._refs.get(unique_id, 0) + 1
+            self._evict()
+            return path, False
+        except BaseException:
+            if os.path.exists(part):
+                os.remove(part)
+            raise
+        finally:
+            del self._loading[unique_id]
+            loading.set_result(None)
+
+    def _remove(self, unique_id):
+        self._size -= self._entries.pop(unique_id)
+        path = self.path(unique_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for unique_id in list(self._entries):
+            if self._size <= self.max_bytes:
+                break
+            # In-flight jobs keep their inputs even when we're over budget
+            if not self._refs.get(unique_id):
+                self._remove(unique_id)
+
+
+class ResultCache:
+    """Persistent map from (inputs, entry names, format, profile) to an uploaded archive's file_id"""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._entries.update(json.load(f))
+            except (OSError, ValueError):
+                # A corrupt cache only costs us a recompression
+                self._entries.clear()
+
+    @staticmethod
+    def key(unique_ids, names, fmt, profile):
+        raw = json.dumps([list(unique_ids), list(names), fmt, profile])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        file_id = self._entries.get(key)
+        if file_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return file_id
+
+    def put(self, key, file_id):
+        self._entries[key] = file_id
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._save()
+
+    def forget(self, key):
+        """Drop a file_id Telegram no longer accepts"""
+        if self._entries.pop(key, None) is not None:
+            self._save()
+
+    def _save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.path)
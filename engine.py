@@ -0,0 +1,131 @@
+"""
+Compression engine for the File Compressor Bot.
+Runs archive jobs in a process pool so the bot's event loop never blocks on deflate.
+"""
+
+import asyncio
+import io
+import os
+import zipfile
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+import parallel
+import policy
+
+
+class EngineBusy(Exception):
+    """Raised when the engine already has too many jobs waiting"""
+
+
+def zip_entries(output_path, entries, mode='w', profile=policy.DEFAULT_PROFILE):
+    """Write (path, arcname) entries into a ZIP. Runs inside a worker process."""
+    with zipfile.ZipFile(output_path, mode, zipfile.ZIP_DEFLATED) as zipf:
+        for path, arcname in entries:
+            method, level = policy.choose_for_file(path, arcname, profile)
+            zipf.write(path, arcname, compress_type=method, compresslevel=level)
+    return output_path
+
+
+def zip_bytes(entries, profile=policy.DEFAULT_PROFILE):
+    """Like zip_entries, but build the ZIP in memory and return its bytes. Runs inside a worker process."""
+    buffer = io.BytesIO()
+    zip_entries(buffer, entries, 'w', profile)
+    return buffer.getvalue()
+
+
+class CompressionEngine:
+    """Process pool with global and per-user concurrency limits"""
+
+    def __init__(self, workers=2, per_user=1, max_waiting=16,
+                 block_size=1024 * 1024, block_workers=None, parallel_threshold=8 * 1024 * 1024):
+        self.workers = workers
+        self.per_user = per_user
+        self.max_waiting = max_waiting
+        self.block_size = block_size
+        self.block_workers = block_workers or workers
+        self.parallel_threshold = parallel_threshold
+        self._pool = None
+        self._slots = asyncio.Semaphore(workers)
+        self._user_slots = {}
+        self._user_jobs = {}
+        self._waiting = 0
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    @property
+    def waiting(self):
+        """Number of jobs submitted but not yet running"""
+        return self._waiting
+
+    @property
+    def saturated(self):
+        return self._waiting >= self.max_waiting
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """Hold a global and a per-user slot, e.g. for work running outside the pool"""
+        if self.saturated:
+            raise EngineBusy(f"{self._waiting} jobs already waiting")
+
+        user_slots = self._user_slots.setdefault(user_id, asyncio.Semaphore(self.per_user))
+        self._user_jobs[user_id] = self._user_jobs.get(user_id, 0) + 1
+        self._waiting += 1
+        waiting = True
+        try:
+            async with user_slots:
+                async with self._slots:
+                    self._waiting -= 1
+                    waiting = False
+                    yield
+        finally:
+            if waiting:
+                self._waiting -= 1
+            self._user_jobs[user_id] -= 1
+            if not self._user_jobs[user_id]:
+                # Drop idle users so the dicts don't grow forever
+                del self._user_jobs[user_id]
+                del self._user_slots[user_id]
+
+    async def run(self, user_id, func, *args):
+        """Run func(*args) in the pool once a global and a per-user slot are free"""
+        async with self.slot(user_id):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.pool, func, *args)
+
+    async def compress_parallel(self, user_id, entries, dst, fmt='zip', level=6):
+        """Deflate (path, arcname) entries block by block across the whole pool (zip, gz or tar.gz)"""
+        async with self.slot(user_id):
+            loop = asyncio.get_running_loop()
+
+            def submit(*args):
+                return loop.run_in_executor(self.pool, parallel.deflate_block, *args)
+
+            return await parallel.compress(
+                submit, entries, dst, fmt, level, self.block_size, self.block_workers * 2
+            )
+
+    async def zip(self, user_id, output_path, entries, mode='w', profile=policy.DEFAULT_PROFILE):
+        """Compress entries into output_path without blocking the event loop"""
+        entries = list(entries)
+        if mode == 'w' and len(entries) == 1 and self.parallel_threshold:
+            path, arcname = entries[0]
+            if os.path.getsize(path) >= self.parallel_threshold:
+                method, level = policy.choose_for_file(path, arcname, profile)
+                if method == zipfile.ZIP_DEFLATED:
+                    await self.compress_parallel(user_id, entries, output_path, 'zip', level or 6)
+                    return output_path
+        return await self.run(user_id, zip_entries, output_path, entries, mode, profile)
+
+    async def zip_bytes(self, user_id, entries, profile=policy.DEFAULT_PROFILE):
+        """Compress a small job straight into memory, so its archive never touches the disk"""
+        return await self.run(user_id, zip_bytes, list(entries), profile)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,201 @@
+"""
+Job queue for the File Compressor Bot.
+Every compression job is recorded in SQLite, so a restart can finish or clean up
+what was in flight, and jobs are admitted to the workers fairly across users,
+smallest first.
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+# collecting: merge still receiving files   downloaded: inputs complete, waiting for a worker
+# compressing: building the archive         ready: single file waiting for its caption
+# uploading: sending to Telegram            done / failed: finished
+STATES = ('collecting', 'downloaded', 'compressing', 'ready', 'uploading', 'done', 'failed')
+ACTIVE_STATES = STATES[:5]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    fmt TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    state TEXT NOT NULL,
+    name TEXT,
+    caption TEXT,
+    inputs TEXT NOT NULL DEFAULT '[]',
+    size INTEGER NOT NULL DEFAULT 0,
+    output TEXT,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+"""
+
+
+class JobQueue:
+    """Persistent job records plus a fair-share queue in front of the compression workers"""
+
+    def __init__(self, path, slots=2, starve_after=120.0, keep_finished=7 * 24 * 3600):
+        self.path = path
+        self.slots = slots
+        self.starve_after = starve_after
+        self.running = 0
+        self._running_by_user = {}
+        self._served = {}  # bytes admitted per user since the user was last idle
+        self._waiters = []
+        self._seq = 0
+        self._waits = deque(maxlen=500)  # seconds spent waiting by recently admitted jobs
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # Commits run on the event loop: with WAL, NORMAL skips the fsync per commit and a crash
+        # can only lose the last few transitions, which recovery treats as interrupted anyway
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        # Old history is only useful for a while
+        self.db.execute(
+            "DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?", (time.time() - keep_finished,)
+        )
+        self.db.commit()
+
+    # Records
+
+    def create(self, user_id, chat_id, kind, fmt, profile, inputs=(), size=0, name=None,
+               caption=None, state='downloaded'):
+        """Record a new job; inputs are (unique_id, arcname) pairs from the input cache"""
+        cursor = self.db.execute(
+            "INSERT INTO jobs (user_id, chat_id, kind, fmt, profile, state, name, caption, inputs, size, created)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, kind, fmt, profile, state, name, caption,
+             json.dumps([list(i) for i in inputs]), size, time.time())
+        )
+        self.db.commit()
+        return cursor.lastrowid
+
+    def add_input(self, job_id, unique_id, arcname, size):
+        # One statement, so a long merge doesn't read and rewrite its row per file
+        self.db.execute(
+            "UPDATE jobs SET inputs = json_insert(inputs, '$[#]', json_array(?, ?)), size = size + ? WHERE id = ?",
+            (unique_id, arcname, size, job_id)
+        )
+        self.db.commit()
+
+    def update(self, job_id, **fields):
+        if 'state' in fields and fields['state'] not in STATES:
+            raise ValueError(f"Unknown job state {fields['state']}")
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self.db.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+        self.db.commit()
+
+    def finish(self, job_id, error=None):
+        """Mark a job done, or failed when there is an error"""
+        self.update(job_id, state='failed' if error else 'done', error=error, finished=time.time())
+
+    def _row(self, row):
+        job = dict(row)
+        job['inputs'] = json.loads(job['inputs'])
+        return job
+
+    def get(self, job_id):
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def active(self):
+        """Jobs a previous run left unfinished, oldest first"""
+        rows = self.db.execute(
+            f"SELECT * FROM jobs WHERE state IN ({', '.join('?' * len(ACTIVE_STATES))}) ORDER BY id",
+            ACTIVE_STATES
+        )
+        return [self._row(row) for row in rows]
+
+    # Scheduling
+
+    @asynccontextmanager
+    async def turn(self, job_id, user_id, size, state='compressing'):
+        """Wait until the job may use the workers, then move it to state (None keeps the current one)"""
+        self._seq += 1
+        waiter = {
+            'job_id': job_id, 'user_id': user_id, 'size': size, 'seq': self._seq,
+            'enqueued': time.monotonic(), 'future': asyncio.get_running_loop().create_future(),
+        }
+        self._waiters.append(waiter)
+        self._dispatch()
+        try:
+            await waiter['future']
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif not waiter['future'].cancelled():
+                # Admitted just as we were cancelled - give the slot back
+                self._release(user_id)
+            raise
+
+        self._waits.append(time.monotonic() - waiter['enqueued'])
+        if state:
+            self.update(job_id, state=state, started=time.time())
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    def _release(self, user_id):
+        self.running -= 1
+        self._running_by_user[user_id] -= 1
+        if not self._running_by_user[user_id]:
+            del self._running_by_user[user_id]
+            if not any(w['user_id'] == user_id for w in self._waiters):
+                self._served.pop(user_id, None)
+        self._dispatch()
+
+    def _priority(self, waiter, now):
+        # Users with fewer running jobs and fewer bytes served go first, then smaller jobs;
+        # jobs waiting too long jump ahead
+        user_id = waiter['user_id']
+        starving = now - waiter['enqueued'] >= self.starve_after
+        return (
+            not starving, self._running_by_user.get(user_id, 0), self._served.get(user_id, 0),
+            waiter['size'], waiter['seq']
+        )
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.running < self.slots and self._waiters:
+            waiter = min(self._waiters, key=lambda w: self._priority(w, now))
+            self._waiters.remove(waiter)
+            self.running += 1
+            self._running_by_user[waiter['user_id']] = self._running_by_user.get(waiter['user_id'], 0) + 1
+            self._served[waiter['user_id']] = self._served.get(waiter['user_id'], 0) + waiter['size']
+            waiter['future'].set_result(None)
+
+    # Stats
+
+    @property
+    def depth(self):
+        """Jobs waiting for a worker"""
+        return len(self._waiters)
+
+    def stats(self):
+        now = time.monotonic()
+        waits = sorted(self._waits)
+        counts = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        return {
+            'depth': self.depth,
+            'running': self.running,
+            'slots': self.slots,
+            'oldest_wait': max((now - w['enqueued'] for w in self._waiters), default=0.0),
+            'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+            'p95_wait': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'states': {state: counts.get(state, 0) for state in STATES},
+        }
+
+    def close(self):
+        self.db.close()
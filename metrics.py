@@ -0,0 +1,202 @@
+"""
+Metrics for the File Compressor Bot.
+Stage timings, byte counters, compression ratios and event-loop lag are kept in memory,
+served in the Prometheus text format on a local port and written as one JSON log line per job,
+so it is easy to tell whether the bot is network-, CPU- or disk-bound.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+
+log = logging.getLogger("compressor.jobs")
+
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATIO_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 1.0, 1.05)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+
+class Histogram:
+    """Fixed-bucket histogram, cumulative like Prometheus when rendered"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th value - coarse, but good enough for a chat message"""
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= q * self.count and seen:
+                return bound
+        return 0.0
+
+    def render(self, name, labels=""):
+        lines = []
+        seen = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            seen += count
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {seen}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Process-wide registry; stages are download, compress, upload, edit..."""
+
+    def __init__(self):
+        self.stage_seconds = {}
+        self.stage_bytes = {}
+        self.ratio = Histogram(RATIO_BUCKETS)
+        self.loop_lag = Histogram(LAG_BUCKETS)
+        self.recent_lag = deque(maxlen=120)  # last minute at the default interval
+        self.jobs = {}  # (kind, outcome) -> count
+        self.gauges = {}  # name -> (help, fn)
+        self.counters = {}  # name -> (help, fn)
+
+    def observe(self, stage, seconds, size=0):
+        if stage not in self.stage_seconds:
+            self.stage_seconds[stage] = Histogram(TIME_BUCKETS)
+            self.stage_bytes[stage] = 0
+        self.stage_seconds[stage].observe(seconds)
+        self.stage_bytes[stage] += size
+
+    @contextmanager
+    def timed(self, stage, size=0):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started, size)
+
+    def gauge(self, name, help_text, fn):
+        """Register a value read when /metrics is scraped"""
+        self.gauges[name] = (help_text, fn)
+
+    def counter(self, name, help_text, fn):
+        """Register a total that only goes up, read when /metrics is scraped"""
+        self.counters[name] = (help_text, fn)
+
+    async def sample_loop_lag(self, interval=0.5):
+        """Run forever, recording how late the event loop wakes us up"""
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            lag = max(time.monotonic() - started - interval, 0.0)
+            self.loop_lag.observe(lag)
+            self.recent_lag.append(lag)
+
+    def render(self):
+        lines = [
+            "# HELP compressor_stage_seconds Time spent per stage",
+            "# TYPE compressor_stage_seconds histogram",
+        ]
+        for stage, histogram in sorted(self.stage_seconds.items()):
+            lines += histogram.render("compressor_stage_seconds", f'stage="{stage}"')
+        lines += [
+            "# HELP compressor_stage_bytes_total Bytes moved per stage",
+            "# TYPE compressor_stage_bytes_total counter",
+        ]
+        lines += [f'compressor_stage_bytes_total{{stage="{s}"}} {n}' for s, n in sorted(self.stage_bytes.items())]
+        lines += [
+            "# HELP compressor_ratio Archive size divided by input size",
+            "# TYPE compressor_ratio histogram",
+            *self.ratio.render("compressor_ratio"),
+            "# HELP compressor_event_loop_lag_seconds How late the event loop runs a timer",
+            "# TYPE compressor_event_loop_lag_seconds histogram",
+            *self.loop_lag.render("compressor_event_loop_lag_seconds"),
+            "# HELP compressor_jobs_total Finished jobs",
+            "# TYPE compressor_jobs_total counter",
+        ]
+        lines += [
+            f'compressor_jobs_total{{kind="{kind}",outcome="{outcome}"}} {n}'
+            for (kind, outcome), n in sorted(self.jobs.items())
+        ]
+        for name, (help_text, fn) in sorted(self.counters.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {fn()}"]
+        for name, (help_text, fn) in sorted(self.gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {fn()}"]
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Serve GET /metrics; returns the asyncio server"""
+
+        async def handle(reader, writer):
+            try:
+                request = await reader.readline()
+                while (await reader.readline()).strip():
+                    pass  # headers
+                if request.split()[1:2] == [b'/metrics']:
+                    status, body = "200 OK", self.render().encode()
+                else:
+                    status, body = "404 Not Found", b"not found\n"
+                writer.write(
+                    f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+                )
+                await writer.drain()
+            except (ConnectionError, IndexError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+class JobMetrics:
+    """Stage timings of one job, logged as a single JSON line when it ends"""
+
+    def __init__(self, registry, kind, user_id):
+        self.registry = registry
+        self.kind = kind
+        self.user_id = user_id
+        self.started = time.monotonic()
+        self.stages = {}
+        self.bytes = {}
+
+    @contextmanager
+    def stage(self, name, size=0):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            self.bytes[name] = self.bytes.get(name, 0) + size
+            self.registry.observe(name, seconds, size)
+
+    def finish(self, outcome, input_bytes=0, output_bytes=0):
+        key = (self.kind, outcome)
+        self.registry.jobs[key] = self.registry.jobs.get(key, 0) + 1
+        if input_bytes and output_bytes:
+            self.registry.ratio.observe(output_bytes / input_bytes)
+        log.info(json.dumps({
+            'event': 'job', 'kind': self.kind, 'user_id': self.user_id, 'outcome': outcome,
+            'seconds': round(time.monotonic() - self.started, 3),
+            'stages': {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            'bytes': self.bytes, 'input_bytes': input_bytes, 'output_bytes': output_bytes,
+        }))
+
+
+registry = Metrics()
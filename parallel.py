@@ -0,0 +1,190 @@
+"""
+Parallel deflate for the File Compressor Bot, pigz style.
+A big file is cut into blocks that are deflated independently in the worker pool and
+stitched back into one standard ZIP entry, .gz or .tar.gz file.
+"""
+
+import asyncio
+import io
+import os
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+from collections import deque
+
+WINDOW = 32 * 1024  # deflate history - each block is primed with the tail of the previous one
+FORMATS = ('zip', 'gz', 'tar.gz')
+
+
+def deflate_block(data, level, dictionary, last):
+    """Raw-deflate one block. Runs inside a worker process.
+
+    Every block but the last ends with a sync flush, so the outputs can simply be
+    concatenated into a single valid deflate stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class _TarStream:
+    """Read-only file object producing a tar archive of (path, arcname) entries on the fly"""
+
+    def __init__(self, entries):
+        self._parts = deque()
+        self._pending = deque(entries)
+
+    def _next_member(self):
+        path, arcname = self._pending.popleft()
+        stat = os.stat(path)
+        info = tarfile.TarInfo(arcname)
+        info.size = stat.st_size
+        info.mtime = int(stat.st_mtime)
+        info.mode = 0o644
+        padding = (tarfile.BLOCKSIZE - stat.st_size % tarfile.BLOCKSIZE) % tarfile.BLOCKSIZE
+        self._parts.append(io.BytesIO(info.tobuf()))
+        self._parts.append(open(path, 'rb'))
+        self._parts.append(io.BytesIO(b'\0' * padding))
+        if not self._pending:
+            self._parts.append(io.BytesIO(b'\0' * 2 * tarfile.BLOCKSIZE))
+
+    def read(self, size):
+        chunks = []
+        while size > 0 and (self._parts or self._pending):
+            if not self._parts:
+                # Open members lazily so only one input file is open at a time
+                self._next_member()
+            data = self._parts[0].read(size)
+            if not data:
+                self._parts.popleft().close()
+                continue
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def close(self):
+        while self._parts:
+            self._parts.popleft().close()
+
+
+def _dos_datetime(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01 00:00
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+class _ZipContainer:
+    """Single-entry ZIP written around a precompressed deflate stream"""
+
+    def __init__(self, arcname, mtime):
+        self.name = arcname.encode('utf-8')
+        self.flags = 0 if arcname.isascii() else 0x800  # UTF-8 names
+        self.dostime, self.dosdate = _dos_datetime(mtime)
+
+    def header(self):
+        # CRC and sizes are zero for now, trailer() patches them in
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, 20, self.flags, zipfile.ZIP_DEFLATED, self.dostime, self.dosdate,
+            0, 0, 0, len(self.name), 0
+        ) + self.name
+
+    def trailer(self, out, crc, csize, usize):
+        if csize >= 0xFFFFFFFF or usize >= 0xFFFFFFFF:
+            raise ValueError("File too large for a ZIP without ZIP64")
+        end = out.tell()
+        out.seek(14)
+        out.write(struct.pack('<III', crc, csize, usize))
+        out.seek(end)
+        central = struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 20 | (3 << 8), 20, self.flags, zipfile.ZIP_DEFLATED,
+            self.dostime, self.dosdate, crc, csize, usize, len(self.name), 0, 0, 0, 0, 0o100644 << 16, 0
+        ) + self.name
+        out.write(central)
+        out.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, 1, 1, len(central), end, 0))
+
+
+class _GzipContainer:
+    def __init__(self, name, mtime):
+        self.name = name.encode('latin-1', 'replace') if name else b''
+        self.mtime = int(mtime)
+
+    def header(self):
+        flags = 0x08 if self.name else 0
+        header = b'\x1f\x8b\x08' + bytes([flags]) + struct.pack('<I', self.mtime) + b'\x00\xff'
+        return header + (self.name + b'\0' if self.name else b'')
+
+    def trailer(self, out, crc, csize, usize):
+        out.write(struct.pack('<II', crc, usize & 0xFFFFFFFF))
+
+
+async def compress(submit, entries, dst, fmt='zip', level=6, block_size=1024 * 1024, inflight=4):
+    """Compress (path, arcname) entries into dst using submit(deflate_block args) -> awaitable.
+
+    fmt is 'zip' or 'gz' (exactly one entry) or 'tar.gz' (any number). At most inflight
+    blocks are compressing or waiting to be written at any time.
+    Returns (input_bytes, output_bytes).
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}")
+    entries = list(entries)
+    if fmt != 'tar.gz' and len(entries) != 1:
+        raise ValueError(f"{fmt} holds exactly one file")
+    src, arcname = entries[0]
+    mtime = os.path.getmtime(src)
+    if fmt == 'zip':
+        reader = open(src, 'rb')
+        container = _ZipContainer(arcname, mtime)
+    elif fmt == 'gz':
+        reader = open(src, 'rb')
+        container = _GzipContainer(arcname, mtime)
+    else:
+        reader = _TarStream(entries)
+        container = _GzipContainer(None, mtime)
+
+    crc = 0
+    usize = 0
+
+    def read_block():
+        nonlocal crc, usize
+        data = reader.read(block_size)
+        crc = zlib.crc32(data, crc)
+        usize += len(data)
+        return data
+
+    pending = deque()
+    csize = 0
+    out = open(dst, 'wb')
+    try:
+        header = container.header()
+        await asyncio.to_thread(out.write, header)
+        data = await asyncio.to_thread(read_block)
+        dictionary = b''
+        while True:
+            following = await asyncio.to_thread(read_block) if data else b''
+            last = not following
+            pending.append(submit(data, level, dictionary, last))
+            dictionary = data[-WINDOW:]
+            # Write finished blocks in order, keeping the pipeline full
+            while pending and (len(pending) >= inflight or last):
+                chunk = await pending.popleft()
+                await asyncio.to_thread(out.write, chunk)
+                csize += len(chunk)
+            if last:
+                break
+            data = following
+        await asyncio.to_thread(container.trailer, out, crc, csize, usize)
+    except BaseException:
+        for future in pending:
+            future.cancel()
+        out.close()
+        os.remove(dst)
+        raise
+    finally:
+        reader.close()
+    out.close()
+    return usize, os.path.getsize(dst)
@@ -0,0 +1,102 @@
+"""
+Compression policy for the File Compressor Bot.
+Picks a ZIP method and level per entry from its name and a small sample of its content.
+"""
+
+import math
+import mimetypes
+import os
+import zipfile
+from collections import Counter
+
+SAMPLE_SIZE = 8 * 1024
+ENTROPY_LIMIT = 7.5  # bits per byte; above this the data is effectively random
+
+# Formats that are already compressed - deflating them again only burns CPU
+STORED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.mkv', '.mov', '.avi', '.webm', '.m4v',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4',
+    '.apk', '.aab', '.jar', '.ipa', '.docx', '.xlsx', '.pptx', '.epub', '.odt',
+}
+
+TEXT_EXTENSIONS = {
+    '.txt', '.csv', '.tsv', '.json', '.xml', '.html', '.htm', '.md', '.log', '.sql', '.svg',
+    '.py', '.js', '.ts', '.css', '.c', '.h', '.cpp', '.java', '.go', '.rs', '.sh', '.yml', '.yaml', '.ini',
+}
+
+# profile -> (text method, text level, binary method, binary level)
+PROFILES = {
+    'fast': (zipfile.ZIP_DEFLATED, 1, zipfile.ZIP_DEFLATED, 1),
+    'balanced': (zipfile.ZIP_DEFLATED, 9, zipfile.ZIP_DEFLATED, 6),
+    'max': (zipfile.ZIP_LZMA, None, zipfile.ZIP_BZIP2, 9),
+}
+DEFAULT_PROFILE = 'balanced'
+
+PROFILE_LABELS = {
+    'fast': "⚡ Fast",
+    'balanced': "⚖️ Balanced",
+    'max': "🗜 Max ratio",
+}
+
+
+def entropy(sample):
+    """Shannon entropy of sample in bits per byte"""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(n / total * math.log2(n / total) for n in Counter(sample).values())
+
+
+def read_sample(path, size=SAMPLE_SIZE):
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def is_precompressed(name):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in STORED_EXTENSIONS:
+        return True
+    mime = mimetypes.guess_type(name)[0] or ''
+    # Raw formats (bmp, wav, svg) still compress well
+    return mime.startswith(('video/', 'audio/')) and ext not in ('.wav', '.aiff')
+
+
+def is_text(name, sample):
+    if os.path.splitext(name)[1].lower() in TEXT_EXTENSIONS:
+        return True
+    mime = mimetypes.guess_type(name)[0] or ''
+    return mime.startswith('text/') or (bool(sample) and b'\0' not in sample and entropy(sample) < 5.0)
+
+
+def choose(name, sample, profile=DEFAULT_PROFILE):
+    """Return (compress_type, compresslevel) for an entry called name starting with sample"""
+    if is_precompressed(name) or entropy(sample) >= ENTROPY_LIMIT:
+        return zipfile.ZIP_STORED, None
+    text_method, text_level, bin_method, bin_level = PROFILES.get(profile, PROFILES[DEFAULT_PROFILE])
+    if is_text(name, sample):
+        return text_method, text_level
+    return bin_method, bin_level
+
+
+def choose_for_file(path, name, profile=DEFAULT_PROFILE):
+    return choose(name, read_sample(path), profile)
+
+
+def deflate_level(path, name, profile=DEFAULT_PROFILE):
+    """Deflate level for formats that can only deflate (gz, tar.gz)"""
+    method, level = choose_for_file(path, name, profile)
+    if method == zipfile.ZIP_STORED:
+        return 1  # nothing to gain, spend as little CPU as possible
+    if method != zipfile.ZIP_DEFLATED:
+        return 9
+    return level or 6
+
+
+def deflate_level_for(entries, profile=DEFAULT_PROFILE):
+    """One deflate level for a whole stream of (path, name) entries: the one covering the most bytes"""
+    weights = Counter()
+    for path, name in entries:
+        weights[deflate_level(path, name, profile)] += os.path.getsize(path) or 1
+    return weights.most_common(1)[0][0] if weights else 6
@@ -0,0 +1,150 @@
+"""
+Progress messages for the File Compressor Bot.
+Coalesces byte-level progress into at most one message edit per interval, so
+long jobs don't run into Telegram's flood limits.
+"""
+
+import asyncio
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, RetryAfter
+
+from metrics import registry
+
+
+def format_size(size):
+    return f"{size / 1024 / 1024:.1f}MB"
+
+
+def retry_delay(error):
+    """Seconds to wait after a RetryAfter, whatever type the library hands us"""
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        delay = delay.total_seconds()
+    return float(delay)
+
+
+class ProgressReader:
+    """File object that reports how far it has been read, e.g. by an upload streaming it"""
+
+    def __init__(self, file, callback):
+        self.file = file
+        self.callback = callback
+        self.done = 0
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.done += len(data)
+        self.callback(self.done)
+        return data
+
+    def seek(self, offset, whence=0):
+        position = self.file.seek(offset, whence)
+        if offset == 0 and whence == 0:
+            self.done = 0  # read again from the start, e.g. a retried request
+        return position
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class ProgressReporter:
+    """Rate-limited progress bar living in one Telegram message"""
+
+    BAR_WIDTH = 20
+
+    def __init__(self, message, interval=3.0, parse_mode="Markdown"):
+        self.message = message
+        self.interval = interval
+        self.parse_mode = parse_mode
+        self.title = ""
+        self.detail = None
+        self.done = 0
+        self.total = 0
+        self._last_text = None
+        self._next_edit = 0.0
+        self._task = None
+        self._finished = False
+
+    def start(self, title, total=0, detail=None):
+        """Begin a new stage (download, compress, upload...) with its own byte total"""
+        self.title = title
+        self.total = total or 0
+        self.done = 0
+        self.detail = detail
+        self._finished = False
+        self._schedule()
+
+    def update(self, done, total=None, detail=None):
+        """Record progress - cheap, the edit itself happens later in the background"""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if detail is not None:
+            self.detail = detail
+        self._schedule()
+
+    def add(self, size):
+        self.update(self.done + size)
+
+    def render(self):
+        lines = [self.title, ""]
+        if self.detail:
+            lines.append(self.detail)
+        if self.total:
+            progress = min(self.done / self.total, 1.0)
+            bars = int(progress * self.BAR_WIDTH)
+            lines.append(f"```{'█' * bars}{'░' * (self.BAR_WIDTH - bars)}```")
+            lines.append(f"{format_size(self.done)} / {format_size(self.total)} ({progress:.0%})")
+        elif self.done:
+            lines.append(format_size(self.done))
+        return "\n".join(lines).rstrip()
+
+    def _schedule(self):
+        if self._finished:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while True:
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                # Render after sleeping so we show the newest numbers
+                await self._edit(self.render())
+                return
+            except RetryAfter as e:
+                self._next_edit = time.monotonic() + retry_delay(e)
+            except Exception:
+                # Progress is cosmetic, never let it break the job
+                return
+
+    async def _edit(self, text, **kwargs):
+        """Edit the message unless nothing changed"""
+        if text == self._last_text and not kwargs:
+            return
+        kwargs.setdefault('parse_mode', self.parse_mode)
+        try:
+            with registry.timed('edit'):
+                await self.message.edit_text(text, **kwargs)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._last_text = text
+        self._next_edit = time.monotonic() + self.interval
+
+    async def finish(self, text, **kwargs):
+        """Replace the progress bar with a final message; this edit waits out flood control"""
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        self._task = None
+        self._finished = True
+        while True:
+            try:
+                await self._edit(text, **kwargs)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(retry_delay(e))
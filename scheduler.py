@@ -0,0 +1,44 @@
+"""
+Download scheduling for the File Compressor Bot.
+With concurrent updates every document is handled in parallel, so downloads are
+capped globally and per user, and each user's state changes are serialized.
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class DownloadScheduler:
+    """Global and per-user limits on parallel downloads, plus a state lock per user"""
+
+    def __init__(self, max_downloads=8, per_user=3):
+        self.max_downloads = max_downloads
+        self.per_user = per_user
+        self.active = 0
+        self._slots = asyncio.Semaphore(max_downloads)
+        self._user_slots = {}
+        self._user_waiting = {}
+        self._locks = {}
+
+    @asynccontextmanager
+    async def slot(self, user_id):
+        """Wait for a free download slot"""
+        user_slots = self._user_slots.setdefault(user_id, asyncio.Semaphore(self.per_user))
+        self._user_waiting[user_id] = self._user_waiting.get(user_id, 0) + 1
+        try:
+            async with user_slots:
+                async with self._slots:
+                    self.active += 1
+                    try:
+                        yield
+                    finally:
+                        self.active -= 1
+        finally:
+            self._user_waiting[user_id] -= 1
+            if not self._user_waiting[user_id]:
+                del self._user_waiting[user_id]
+                del self._user_slots[user_id]
+
+    def lock(self, user_id):
+        """Lock guarding a user's context.user_data across awaits"""
+        return self._locks.setdefault(user_id, asyncio.Lock())
@@ -0,0 +1,210 @@
+"""
+Temp storage for the File Compressor Bot.
+Every job builds its archives in a private directory, all directories share one disk quota,
+small finished archives are kept in memory instead of on disk, and a janitor reclaims the
+space of sessions nobody has touched for a while.
+"""
+
+import asyncio
+import io
+import os
+import shutil
+import time
+import uuid
+from collections import deque
+
+
+class Spool:
+    """A finished output: its bytes in memory when small, otherwise the file on disk"""
+
+    def __init__(self, path, max_memory):
+        self.size = os.path.getsize(path)
+        self.path = None
+        self.data = None
+        # Formats that can't build in memory are read back once and the file dropped
+        if self.size <= max_memory:
+            with open(path, 'rb') as f:
+                self.data = f.read()
+            os.remove(path)
+        else:
+            self.path = path
+
+    @property
+    def closed(self):
+        return self.data is None and self.path is None
+
+    @classmethod
+    def from_bytes(cls, data):
+        """An output the worker already returned in memory"""
+        spool = cls.__new__(cls)
+        spool.size = len(data)
+        spool.path = None
+        spool.data = data
+        return spool
+
+    def open(self):
+        return io.BytesIO(self.data) if self.data is not None else open(self.path, 'rb')
+
+    def close(self):
+        self.data = None
+        self.path = None
+
+
+class JobSpace:
+    """A job's private directory and its share of the disk quota"""
+
+    def __init__(self, storage, owner):
+        self.storage = storage
+        self.owner = owner
+        self.directory = os.path.join(storage.directory, f"{owner}_{uuid.uuid4().hex}")
+        self.reserved = 0
+        self.touched = time.monotonic()
+        self.closed = False
+        self.on_expire = None  # called before the janitor closes the space, to free what lives elsewhere
+        self._spools = []
+
+    def path(self, name):
+        """Path for a file of this job; the directory is created on first use"""
+        self.touch()
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def touch(self):
+        self.touched = time.monotonic()
+
+    async def claim(self, size):
+        """Reserve quota for size more bytes, waiting while the disk is full"""
+        await self.storage.claim(size, self)
+        if self.closed:
+            # Expired while we were waiting
+            self.storage.release(size)
+            return
+        self.reserved += size
+        self.touch()
+
+    def try_claim(self, size):
+        """Reserve quota for size more bytes only if that needs no waiting; returns whether it did"""
+        if self.closed or not self.storage.try_claim(size, self):
+            return False
+        self.reserved += size
+        self.touch()
+        return True
+
+    def release(self):
+        """Hand back the whole reservation, for a job about to claim its files again from scratch"""
+        self.storage.release(self.reserved)
+        self.reserved = 0
+
+    def keep(self, path):
+        """Turn a finished file into a Spool that lives as long as this space"""
+        spool = Spool(path, self.storage.spool_max)
+        self._spools.append(spool)
+        self.touch()
+        return spool
+
+    def hold(self, data):
+        """Keep bytes the worker built in memory for as long as this space lives"""
+        spool = Spool.from_bytes(data)
+        self._spools.append(spool)
+        self.touch()
+        return spool
+
+    def close(self):
+        """Free everything the job held: files, spooled bytes and quota"""
+        if self.closed:
+            return
+        self.closed = True
+        for spool in self._spools:
+            spool.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.storage.release(self.reserved)
+        self.reserved = 0
+        self.storage.spaces.discard(self)
+
+
+class Storage:
+    """Per-job directories under one disk quota, plus the janitor for abandoned ones"""
+
+    def __init__(self, directory, quota, spool_max=1024 * 1024, ttl=3600.0, patience=30.0):
+        self.directory = directory
+        self.quota = quota
+        self.patience = patience
+        self.spool_max = spool_max
+        self.ttl = ttl
+        self.used = 0
+        self.spaces = set()
+        self._waiters = deque()
+        # Nothing in here survives a restart - interrupted jobs are rebuilt from the input cache
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def waiting(self):
+        """Claims waiting for disk space"""
+        return len(self._waiters)
+
+    def space(self, owner):
+        space = JobSpace(self, owner)
+        self.spaces.add(space)
+        return space
+
+    def _fits(self, size, owner=None):
+        # A claim bigger than the whole quota still runs, just on its own - and a space
+        # never waits on bytes it holds itself
+        held = owner.reserved if owner is not None else 0
+        return self.used + size <= self.quota or self.used - held <= 0
+
+    def _overdue(self):
+        """The oldest waiter has waited long enough that nobody may overtake it any more"""
+        return bool(self._waiters) and time.monotonic() - self._waiters[0][3] >= self.patience
+
+    def try_claim(self, size, owner=None):
+        if self._overdue() or not self._fits(size, owner):
+            return False
+        self.used += size
+        return True
+
+    async def claim(self, size, owner=None):
+        if self.try_claim(size, owner):
+            return
+        waiter = (size, asyncio.get_running_loop().create_future(), owner, time.monotonic())
+        self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self.release(0)  # the ones behind us may fit now
+            elif not waiter[1].cancelled():
+                # Granted just as we were cancelled - hand the bytes back
+                self.release(size)
+            raise
+
+    def release(self, size):
+        self.used -= size
+        # Claims that fit may overtake a big one in front of them, but only for a while,
+        # so the big one can't be starved by small ones either
+        for waiter in list(self._waiters):
+            size, future, owner, _ = waiter
+            if self._fits(size, owner):
+                self._waiters.remove(waiter)
+                self.used += size
+                future.set_result(None)
+            elif waiter is self._waiters[0] and self._overdue():
+                break
+
+    def expire(self):
+        """Close spaces idle for longer than the TTL; returns how many were closed"""
+        cutoff = time.monotonic() - self.ttl
+        expired = [space for space in self.spaces if space.touched < cutoff]
+        for space in expired:
+            if space.on_expire:
+                space.on_expire()
+            space.close()
+        return len(expired)
+
+    async def janitor(self, interval=60.0):
+        """Run forever, reclaiming abandoned job spaces"""
+        while True:
+            await asyncio.sleep(interval)
+            self.expire()
@@ -0,0 +1,197 @@
+"""
+Streaming download -> ZIP -> upload pipeline.
+Chunks flow through small bounded queues, so memory stays flat and nothing is written to disk.
+"""
+
+import asyncio
+import os
+import shutil
+import uuid
+import zipfile
+
+import httpx
+from telegram import Message
+from telegram.error import TelegramError
+
+import policy
+
+_DONE = object()
+
+
+class StreamAborted(Exception):
+    """Fed to the compressor thread when the pipeline stops early"""
+
+
+class _QueueWriter:
+    """Unseekable file object that hands zipfile output to an asyncio queue"""
+
+    def __init__(self, queue, loop):
+        self.queue = queue
+        self.loop = loop
+
+    def write(self, data):
+        if data:
+            # Blocks this thread while the queue is full - that's our backpressure
+            asyncio.run_coroutine_threadsafe(self.queue.put(bytes(data)), self.loop).result()
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _compress(inbox, outbox, loop, arcname, profile):
+    """Thread body: compress chunks from inbox into a one-entry ZIP written to outbox"""
+
+    def next_chunk():
+        chunk = asyncio.run_coroutine_threadsafe(inbox.get(), loop).result()
+        if isinstance(chunk, BaseException):
+            raise chunk
+        return chunk
+
+    marker = _DONE
+    try:
+        # The first chunk doubles as the policy sample
+        chunk = next_chunk()
+        method, level = policy.choose(arcname, b'' if chunk is _DONE else chunk[:policy.SAMPLE_SIZE], profile)
+        with zipfile.ZipFile(_QueueWriter(outbox, loop), 'w', method, compresslevel=level) as zipf:
+            with zipf.open(arcname, 'w') as entry:
+                while chunk is not _DONE:
+                    entry.write(chunk)
+                    chunk = next_chunk()
+    except BaseException as e:
+        marker = e
+    asyncio.run_coroutine_threadsafe(outbox.put(marker), loop).result()
+
+
+async def _download(client, url, inbox, chunk_size, max_bytes, progress):
+    """Feed the compressor with chunks straight from the HTTP response"""
+    received = 0
+    async with client.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(chunk_size):
+            received += len(chunk)
+            if max_bytes and received > max_bytes:
+                raise ValueError(f"File is larger than {max_bytes / 1024 / 1024:.0f}MB")
+            await inbox.put(chunk)
+            if progress:
+                progress(received)
+    await inbox.put(_DONE)
+    return received
+
+
+async def download_to_path(file, path, progress=None, chunk_size=256 * 1024, client=None):
+    """Download a telegram File to path, calling progress(bytes_so_far) as chunks arrive"""
+    if not file.file_path.startswith(("http://", "https://")):
+        # A local Bot API server already has the file on disk - link it instead of copying
+        try:
+            os.link(file.file_path, path)
+        except OSError:
+            # Different filesystem, or links not allowed
+            await asyncio.to_thread(shutil.copyfile, file.file_path, path)
+        size = os.path.getsize(path)
+        if progress:
+            progress(size)
+        return size
+
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=None))
+    received = 0
+    try:
+        with open(path, 'wb') as f:
+            async with client.stream("GET", file.file_path) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(chunk_size):
+                    f.write(chunk)
+                    received += len(chunk)
+                    if progress:
+                        progress(received)
+    finally:
+        if own_client:
+            await client.aclose()
+    return received
+
+
+async def _upload(client, bot, outbox, chat_id, filename, caption, parse_mode):
+    """POST sendDocument with a multipart body generated from the compressor output"""
+    boundary = uuid.uuid4().hex
+    fields = {"chat_id": chat_id}
+    if caption:
+        fields["caption"] = caption
+        if parse_mode:
+            fields["parse_mode"] = parse_mode
+    safe_name = filename.replace('"', "'")
+
+    async def body():
+        for name, value in fields.items():
+            yield (
+                f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+            ).encode()
+        yield (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="document"; filename="{safe_name}"\r\n'
+            "Content-Type: application/zip\r\n\r\n"
+        ).encode()
+        while True:
+            chunk = await outbox.get()
+            if chunk is _DONE:
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    response = await client.post(
+        f"{bot.base_url}/sendDocument",
+        content=body(),
+        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+    )
+    data = response.json()
+    if not data.get("ok"):
+        raise TelegramError(data.get("description", f"HTTP {response.status_code}"))
+    return Message.de_json(data["result"], bot)
+
+
+async def _stop_worker(inbox, outbox, worker):
+    """Unblock the compressor thread after a failure so it can exit"""
+    aborted = False
+    while not worker.done():
+        while not outbox.empty():
+            outbox.get_nowait()
+        if not aborted and not inbox.full():
+            inbox.put_nowait(StreamAborted("pipeline stopped"))
+            aborted = True
+        await asyncio.sleep(0.01)
+
+
+async def stream_zip_upload(bot, file_url, chat_id, arcname, filename, caption=None, parse_mode=None,
+                            chunk_size=256 * 1024, buffer_chunks=8, max_bytes=None, client=None,
+                            profile=policy.DEFAULT_PROFILE, progress=None, upload_client=None):
+    """Download file_url, ZIP it on the fly and upload it as a document to chat_id.
+
+    At most 2 * buffer_chunks chunks are held in memory at any time.
+    Pass client to reuse an existing httpx.AsyncClient, and upload_client to send the
+    upload through a different one than the download. progress(bytes_so_far) is called
+    as the download advances. Returns the sent Message.
+    """
+    loop = asyncio.get_running_loop()
+    inbox = asyncio.Queue(buffer_chunks)
+    outbox = asyncio.Queue(buffer_chunks)
+    worker = loop.run_in_executor(None, _compress, inbox, outbox, loop, arcname, profile)
+
+    own_client = client is None
+    if own_client:
+        client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=None, write=None))
+    upload_client = upload_client or client
+    try:
+        download = asyncio.ensure_future(_download(client, file_url, inbox, chunk_size, max_bytes, progress))
+        upload = asyncio.ensure_future(_upload(upload_client, bot, outbox, chat_id, filename, caption, parse_mode))
+        try:
+            await asyncio.gather(download, upload)
+        finally:
+            for task in (download, upload):
+                task.cancel()
+            await _stop_worker(inbox, outbox, worker)
+    finally:
+        if own_client:
+            await client.aclose()
+    return upload.result()